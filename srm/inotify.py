@@ -0,0 +1,106 @@
+"""
+Minimal ctypes based inotify bindings that cooperate with eventlet
+"""
+import os
+import struct
+import ctypes
+import ctypes.util
+from errno import EAGAIN, EINTR
+from eventlet import Timeout
+from eventlet.hubs import trampoline
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+_event_header = struct.Struct('iIII')
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        # make sure the calls we need are actually there
+        libc.inotify_init1
+        libc.inotify_add_watch
+        _libc = libc
+    return _libc
+
+
+def inotify_available():
+    """Check if inotify can be used on this host
+
+    :returns: True if inotify is available
+    """
+    try:
+        _load_libc()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+class Inotify(object):
+    """Watch paths for changes using inotify"""
+
+    def __init__(self):
+        try:
+            self.libc = _load_libc()
+        except AttributeError:
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        """Start watching a path
+
+        :param path: file or directory to watch
+        :param mask: inotify event mask to watch for
+        :returns: watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout=None):
+        """Wait for and read pending events
+
+        :param timeout: seconds to wait for events, None to wait forever
+        :returns: list of (watched path, name, mask) tuples, empty if the
+                  timeout expired
+        """
+        with Timeout(timeout, False):
+            trampoline(self.fd, read=True)
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, err:
+            if err.errno in (EAGAIN, EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + _event_header.size <= len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, pos)
+            pos += _event_header.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((self.watches.get(wd), name, mask))
+        return events
+
+    def close(self):
+        """Stop watching everything"""
+        os.close(self.fd)
@@ -4,20 +4,51 @@ Ring Master Daemon for ring orchestration
 
 import os
 import sys
+import fcntl
+import signal
 import optparse
 import subprocess
 import cPickle as pickle
-from os.path import exists
-from time import time, sleep, gmtime
+from copy import copy
+from array import array
+from os.path import exists, dirname, abspath, join as pathjoin
+from time import time, gmtime
+from eventlet import sleep, tpool, spawn_n, GreenPool, Timeout
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+from eventlet.hubs import trampoline
 from tempfile import mkstemp
 from datetime import datetime
 from os import stat, unlink, rename, close, fdopen, chmod
 from swift.common import exceptions
 from swift.common.ring import RingBuilder
 from swift.common.utils import get_logger, readconf, TRUE_VALUES, json, \
-    lock_parent_directory
+    lock_file
 from srm.utils import get_md5sum, make_backup, Daemon, is_valid_ring, \
-    EmailNotify
+    EmailNotify, write_md5_sidecar, read_md5_sidecar, remove_md5_sidecar, \
+    run_in_child, WorkerError
+from srm.ringstats import get_stats
+from srm.inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_MOVED_FROM, \
+    IN_CREATE, IN_DELETE, IN_Q_OVERFLOW
+
+
+def _rebalance_builder(builder):
+    """Rebalance a builder, run in a worker process
+
+    :param builder: builder to rebalance
+    :returns: tuple of parts moved, balance and the new builder dict
+    """
+    parts, balance = builder.rebalance()[:2]
+    return parts, balance, builder.to_dict()
+
+
+def _save_ring(builder, ring_file):
+    """Serialize a builders ring, run in a worker process
+
+    :param builder: builder to get the ring from
+    :param ring_file: where to save the ring
+    """
+    builder.get_ring().save(ring_file)
 
 
 class RingMasterServer(object):
@@ -58,6 +89,24 @@ class RingMasterServer(object):
                                'object': float(conf.get('object_min_pct',
                                                         '99.75'))}
         self.lock_timeout = int(conf.get('lock_timeout', '90'))
+        self.status_file = conf.get('status_file', '/tmp/.srm-status')
+        self.next_run = dict((btype, 0) for btype in self.builder_files)
+        self.last_result = {}
+        self.use_inotify = conf.get('use_inotify', 'y') in TRUE_VALUES
+        self.idle_interval = int(conf.get('idle_interval', '3600'))
+        self.events_active = False
+        self.wakeups = dict((btype, Event()) for btype in self.builder_files)
+        self.resume = Event()
+        self.known_identity = {}
+        self.gate_opens = {}
+        self.builder_cache = {}
+        self.ring_pending = set()
+        self.isolate_rebalance = conf.get('isolate_rebalance',
+                                          'y') in TRUE_VALUES
+        self.rebalance_timeout = int(conf.get('rebalance_timeout', '3600'))
+        self.rebalance_memory_limit = \
+            int(conf.get('rebalance_memory_limit', '0')) * 1024 * 1024
+        self.worker_slots = Semaphore(int(conf.get('rebalance_workers', '1')))
         window = conf.get('change_window', '0000,2400')
         self.change_window = [int(x) for x in window.split(',')]
         if self.debug:
@@ -81,9 +130,22 @@ class RingMasterServer(object):
         if exists(self.pause_file):
             self.logger.notice('--> Pause file found. Pausing orchestration!')
             while exists(self.pause_file):
-                sleep(1)
+                self._wait_for_resume()
             self.logger.notice('--> Pause removed. Resuming orchestration!')
 
+    def _wait_for_resume(self):
+        """Wait for the pause file to go away, or just a second if we
+        aren't watching for it"""
+        if not self.events_active:
+            sleep(1)
+            return
+        resume = self.resume
+        if resume.ready():
+            resume = self.resume = Event()
+        # recheck once in a while in case we missed the event
+        with Timeout(60, False):
+            resume.wait()
+
     def rebalance_ring(self, builder):
         """Rebalance a ring
 
@@ -93,12 +155,16 @@ class RingMasterServer(object):
         self.pause_if_asked()
         devs_changed = builder.devs_changed
         try:
-            last_balance = builder.get_balance()
-            parts, balance = builder.rebalance()
+            last_balance = get_stats(builder).balance
+            parts, balance = self._rebalance(builder)
         except exceptions.RingBuilderError:
             self.logger.error("-> Rebalance failed!")
             self.logger.exception('RingBuilderError')
             return False
+        except WorkerError:
+            self.logger.error("-> Rebalance failed!")
+            self.logger.exception('Rebalance worker error')
+            return False
         if not parts:
             self.logger.notice("-> No partitions reassigned!")
             self.logger.notice("-> (%d/%.02f)" % (parts, balance))
@@ -111,6 +177,31 @@ class RingMasterServer(object):
                                           balance))
         return True
 
+    def _in_worker(self, func, *args):
+        """Run something in a worker process, if isolation is enabled
+
+        :param func: function to run
+        :param args: arguments for func
+        :returns: what func returned
+        """
+        if not self.isolate_rebalance:
+            return func(*args)
+        with self.worker_slots:
+            return run_in_child(func, args, timeout=self.rebalance_timeout,
+                                memory_limit=self.rebalance_memory_limit,
+                                tmpdir=self.swiftdir)
+
+    def _rebalance(self, builder):
+        """Rebalance a builder, in a worker process if isolation is enabled
+
+        :param builder: builder to rebalance, updated in place
+        :returns: tuple of parts moved and new balance
+        """
+        parts, balance, state = self._in_worker(_rebalance_builder, builder)
+        if self.isolate_rebalance:
+            builder.copy_from(state)
+        return parts, balance
+
     def adjust_ring(self, builder):
         """Adjust device weights in a ring
 
@@ -196,8 +287,10 @@ class RingMasterServer(object):
         self.logger.debug("--> Running %s dispersion report" % swift_type)
         dsp_cmd = [self.dispersion_cmd, '-j', '--%s-only' % swift_type]
         try:
-            result = json.loads(subprocess.Popen(dsp_cmd,
-                                stdout=subprocess.PIPE).communicate()[0])
+            # run in a real thread so other rings carry on in the meantime
+            result = json.loads(tpool.execute(
+                lambda: subprocess.Popen(dsp_cmd, stdout=subprocess.PIPE)
+                .communicate()[0]))
         except Exception:
             self.logger.exception('Error running dispersion report')
             return False
@@ -253,9 +346,9 @@ class RingMasterServer(object):
         :returns: True ring balance is ok
         """
         self.pause_if_asked()
-        self.logger.debug(
-            '--> Current balance: %.02f' % builder.get_balance())
-        return builder.get_balance() <= self.balance_threshold
+        balance = get_stats(builder).balance
+        self.logger.debug('--> Current balance: %.02f' % balance)
+        return balance <= self.balance_threshold
 
     def write_builder(self, btype, builder):
         """Write out new builder file
@@ -273,6 +366,12 @@ class RingMasterServer(object):
             self.logger.notice('--> Backed up %s to %s (%s)' %
                               (builder_file, backup, backup_md5))
             chmod(tmppath, 0644)
+            builder_md5 = get_md5sum(tmppath)
+            try:
+                write_md5_sidecar(builder_file, builder_md5, tmppath)
+            except (IOError, OSError):
+                self.logger.exception('Unable to write builder md5 sidecar')
+                remove_md5_sidecar(builder_file)
             rename(tmppath, builder_file)
         except Exception as err:
             raise Exception('Error writing builder: %s' % err)
@@ -287,43 +386,174 @@ class RingMasterServer(object):
                     unlink(tmppath)
                 except OSError:
                     pass
-        return get_md5sum(builder_file)
+        return builder_md5
+
+    def prepare_ring(self, btype, builder):
+        """Serialize and validate a builders ring ready to be written out.
+        This can take a while so its done without holding the builder lock.
+
+        :param btype: The builder type
+        :param builder: The builder to get the ring from
+        :returns: path of the tmp ring file
+        """
+        self.pause_if_asked()
+        fd, tmppath = mkstemp(dir=self.swiftdir, suffix='.tmp.ring.gz')
+        close(fd)
+        try:
+            self._in_worker(_save_ring, builder, tmppath)
+            if not is_valid_ring(tmppath):
+                raise Exception('Ring Validate Failed')
+        except Exception as err:
+            try:
+                unlink(tmppath)
+            except OSError:
+                pass
+            raise Exception('Error serializing ring: %s' % err)
+        return tmppath
 
-    def write_ring(self, btype, builder):
+    def write_ring(self, btype, builder, prepared=None):
         """Write out new ring files
 
         :param btype: The builder type
         :param builder: The builder to dump
+        :param prepared: tmp ring file from prepare_ring, if its been done
         :returns: new ring file md5
         """
+        tmppath = prepared
         try:
             self.pause_if_asked()
             ring_file = self.ring_files[btype]
-            fd, tmppath = mkstemp(dir=self.swiftdir, suffix='.tmp.ring.gz')
-            builder.get_ring().save(tmppath)
-            close(fd)
-            if not is_valid_ring(tmppath):
-                unlink(tmppath)
-                raise Exception('Ring Validate Failed')
+            if not tmppath:
+                tmppath = self.prepare_ring(btype, builder)
             backup, backup_md5 = make_backup(ring_file, self.backup_dir)
             self.logger.notice('--> Backed up %s to %s (%s)' %
                               (ring_file, backup, backup_md5))
             chmod(tmppath, 0644)
+            ring_md5 = get_md5sum(tmppath)
+            try:
+                write_md5_sidecar(ring_file, ring_md5, tmppath)
+            except (IOError, OSError):
+                # the sidecar just saves readers an md5, don't hold the
+                # ring back for it
+                self.logger.exception('Unable to write ring md5 sidecar')
+                remove_md5_sidecar(ring_file)
             rename(tmppath, ring_file)
         except Exception as err:
-            raise Exception('Error writing builder: %s' % err)
+            raise Exception('Error writing ring: %s' % err)
         finally:
-            if fd:
-                try:
-                    close(fd)
-                except OSError:
-                    pass
             if tmppath:
                 try:
                     unlink(tmppath)
                 except OSError:
                     pass
-        return get_md5sum(ring_file)
+        return ring_md5
+
+    def _builder_identity(self, btype):
+        """Identify the current version of a builder file, so we can tell
+        if its been replaced while we were working on it
+
+        :param btype: The builder type
+        :returns: tuple of the builder files inode, mtime, size and md5 from
+                  its sidecar (None if theres no current sidecar)
+        """
+        st = stat(self.builder_files[btype])
+        return (st.st_ino, st.st_mtime, st.st_size,
+                read_md5_sidecar(self.builder_files[btype], st))
+
+    def _ring_lock(self, btype):
+        """Lock a single ring's builder, so passes on the other rings don't
+        have to wait on this one
+
+        :param btype: The builder type to lock
+        :returns: context manager that holds the lock
+        """
+        return lock_file(self.builder_files[btype] + '.lock',
+                         self.lock_timeout, unlink=False)
+
+    def load_builder(self, btype):
+        """Load a builder, reusing the last one loaded if the file hasn't
+        changed since. The builder returned is shared and must not be
+        modified, use _working_copy if it needs changes.
+
+        :param btype: The builder type
+        :returns: tuple of builder identity and the builder
+        """
+        identity = self._builder_identity(btype)
+        cached = self.builder_cache.get(btype)
+        if cached and cached[0] == identity:
+            self.logger.debug('[%s] -> Using cached builder' % btype)
+            return cached
+        builder = RingBuilder.load(self.builder_files[btype])
+        self.builder_cache[btype] = (identity, builder)
+        return identity, builder
+
+    def _working_copy(self, builder):
+        """Get a copy of a builder thats safe to adjust and rebalance without
+        touching the original. Only the parts a rebalance changes are copied,
+        which is far cheaper than loading the builder again.
+
+        :param builder: builder to copy
+        :returns: a new builder
+        """
+        work = copy(builder)
+        work._ring = None
+        work.devs = [dev and dict(dev) for dev in builder.devs]
+        work._remove_devs = list(builder._remove_devs)
+        if builder._replica2part2dev is not None:
+            work._replica2part2dev = [array('H', p2d) for p2d in
+                                      builder._replica2part2dev]
+        if builder._last_part_moves is not None:
+            work._last_part_moves = array('B', builder._last_part_moves)
+        if getattr(builder, '_part_moved_bitmap', None) is not None:
+            work._part_moved_bitmap = bytearray(builder._part_moved_bitmap)
+        if getattr(builder, '_dispersion_graph', None) is not None:
+            work._dispersion_graph = dict(builder._dispersion_graph)
+        return work
+
+    def _publish_ring(self, btype, builder, prepared=None):
+        """Write out the ring for a builder thats already been written,
+        leaving it pending to be retried if that fails. Expects the builder
+        lock to be held.
+
+        :param btype: The builder type
+        :param builder: The builder to dump
+        :param prepared: tmp ring file from prepare_ring, if its been done
+        :returns: True if the ring was written
+        """
+        self.logger.notice("[%s] -> Writing ring..." % btype)
+        try:
+            ring_md5 = self.write_ring(btype, builder, prepared)
+        except Exception:
+            self.logger.exception('Error dumping ring, will retry')
+            return False
+        self.ring_pending.discard(btype)
+        self.logger.notice("[%s] --> Wrote new ring with md5: %s"
+                           % (btype, ring_md5))
+        self._emit_notify('%s ring change' % btype,
+                          'Wrote new ring with md5: %s' % ring_md5)
+        return True
+
+    def _retry_ring(self, btype, builder, identity):
+        """Try again to write out a ring that failed to be written after
+        its builder was
+
+        :param btype: The builder type
+        :param builder: The (already written) builder to dump
+        :param identity: builder identity when the builder was loaded
+        :returns: True if the ring was written
+        """
+        self.logger.notice("[%s] -> Retrying pending ring write" % btype)
+        try:
+            prepared = self.prepare_ring(btype, builder)
+        except Exception:
+            self.logger.exception('Error serializing ring')
+            return False
+        with self._ring_lock(btype):
+            if self._builder_identity(btype) != identity:
+                # start over with whatever builder is there now
+                unlink(prepared)
+                return False
+            return self._publish_ring(btype, builder, prepared)
 
     def orchestration_pass(self, btype):
         """Check the rings, make any needed adjustments, and deploy the ring
@@ -335,7 +565,11 @@ class RingMasterServer(object):
         self.logger.debug("=" * 79)
         self.logger.notice("Checking on %s ring..." % btype)
         self.logger.debug("=" * 79)
-        builder = RingBuilder.load(self.builder_files[btype])
+        with self._ring_lock(btype):
+            identity, builder = self.load_builder(btype)
+        self.known_identity[btype] = identity
+        if btype in self.ring_pending:
+            return self._retry_ring(btype, builder, identity)
         if self.ring_requires_change(builder):
             self.logger.notice("[%s] -> ring requires weight change." % btype)
 
@@ -343,6 +577,8 @@ class RingMasterServer(object):
                 if not self.min_part_hours_ok(builder):
                     self.logger.notice(
                         "[%s] -> Ring min_part_hours: not ready!" % btype)
+                    self.gate_opens[btype] = builder._last_part_moves_epoch \
+                        + (builder.min_part_hours + 1) * 3600
                     return False
                 else:
                     self.logger.notice(
@@ -351,6 +587,8 @@ class RingMasterServer(object):
             if not self.min_modify_time(btype):
                 self.logger.notice(
                     "[%s] -> Ring last modify time: not ready!" % btype)
+                self.gate_opens[btype] = identity[1] + \
+                    self.sec_since_modified + 1
                 return False
             else:
                 self.logger.notice("[%s] -> Ring last modify time: ok" % btype)
@@ -362,6 +600,9 @@ class RingMasterServer(object):
             else:
                 self.logger.notice("[%s] -> Dispersion report: ok" % btype)
 
+            # leave the cached builder alone until the new one is written
+            builder = self._working_copy(builder)
+
             if self.ring_balance_ok(builder):
                 self.logger.notice("[%s] -> Current Ring balance: ok" % btype)
                 self.logger.notice("[%s] -> Adjusting ring..." % btype)
@@ -385,49 +626,210 @@ class RingMasterServer(object):
                     return True  # we should sleep a bit longer
                 else:
                     self.logger.notice("[%s] -> Rebalance: ok" % btype)
-            self.logger.notice("[%s] -> Writing builder..." % btype)
+            self.logger.notice("[%s] -> Serializing ring..." % btype)
             try:
-                builder_md5 = self.write_builder(btype, builder)
+                prepared = self.prepare_ring(btype, builder)
+            except Exception:
+                self.logger.exception('Error serializing ring')
+                return False
+            with self._ring_lock(btype):
+                if self._builder_identity(btype) != identity:
+                    self.logger.notice('[%s] -> Builder changed during '
+                                       'pass, not writing!' % btype)
+                    unlink(prepared)
+                    return False
+                self.logger.notice("[%s] -> Writing builder..." % btype)
+                try:
+                    builder_md5 = self.write_builder(btype, builder)
+                except Exception:
+                    self.logger.exception('Error dumping builder')
+                    unlink(prepared)
+                    return False
                 self.logger.notice('[%s] --> Wrote new builder with md5: '
                                    '%s' % (btype, builder_md5))
-                self.logger.notice("[%s] -> Writing ring..." % btype)
-                ring_md5 = self.write_ring(btype, builder)
-                self.logger.notice("[%s] --> Wrote new ring with md5: %s" %
-                                   (btype, ring_md5))
-                self._emit_notify('%s ring change' % btype,
-                                  'Wrote new ring with md5: %s' % ring_md5)
-                return True
-            except Exception:
-                self.logger.exception('Error dumping builder or ring')
+                identity = self._builder_identity(btype)
+                self.known_identity[btype] = identity
+                self.builder_cache[btype] = (identity, builder)
+                # until the ring is out it no longer matches the builder
+                self.ring_pending.add(btype)
+                return self._publish_ring(btype, builder, prepared)
         else:
             self.logger.notice("[%s] -> No ring change required" % btype)
+            # nothing to do until someone changes the builder
+            self.gate_opens[btype] = time() + self.idle_interval
             return False
 
+    def write_status(self):
+        """Write out when each ring is next due to be checked"""
+        status = {}
+        for btype in self.builder_files:
+            status[btype] = {'next_check': self.next_run[btype],
+                             'last_result': self.last_result.get(btype)}
+        try:
+            fd, tmppath = mkstemp(dir=os.path.dirname(self.status_file) or
+                                  '.', suffix='.tmp')
+            with fdopen(fd, 'w') as f:
+                json.dump(status, f)
+            rename(tmppath, self.status_file)
+        except (IOError, OSError):
+            self.logger.exception('Unable to write status file')
+
+    def run_pass(self, btype):
+        """Run an orchestration pass on a ring and schedule its next one
+
+        :param btype: The builder type to work on.
+        :returns: seconds until the rings next pass
+        """
+        self.gate_opens.pop(btype, None)
+        try:
+            self.pause_if_asked()
+            if self.in_change_window():
+                if self.orchestration_pass(btype):
+                    result = 'changed'
+                    delay = self.recheck_after_change_interval
+                else:
+                    result = 'unchanged'
+                    delay = self.recheck_interval
+                    if self.events_active and btype in self.gate_opens:
+                        # builder changes wake us up, so we only need a
+                        # timer for when the time based checks pass
+                        delay = max(self.gate_opens[btype] - time(), 1)
+            else:
+                self.logger.debug('Not in change window')
+                result = 'outside change window'
+                delay = 60
+        except exceptions.LockTimeout:
+            self.logger.exception('Orchestration LockTimeout Encountered')
+            result = 'lock timeout'
+            delay = 1
+        except Exception:
+            self.logger.exception('Orchestration Error')
+            result = 'error'
+            delay = 60
+        self.next_run[btype] = time() + delay
+        self.last_result[btype] = result
+        self.logger.notice('[%s] -> Next check in %ds (%s)'
+                           % (btype, delay, datetime.utcfromtimestamp(
+                              self.next_run[btype])))
+        self.write_status()
+        return delay
+
+    def orchestration_loop(self, btype):
+        """Keep running passes on a ring as they come due
+
+        :param btype: The builder type to work on.
+        """
+        while True:
+            wakeup = self.wakeups[btype]
+            delay = self.next_run[btype] - time()
+            if delay > 0 and not wakeup.ready():
+                with Timeout(delay, False):
+                    wakeup.wait()
+                continue
+            self.wakeups[btype] = Event()
+            self.run_pass(btype)
+
+    def wake(self, btype):
+        """Run a pass on a ring right away
+
+        :param btype: The builder type to wake up
+        """
+        self.logger.debug('[%s] -> Woken up' % btype)
+        if not self.wakeups[btype].ready():
+            self.wakeups[btype].send()
+
+    def handle_event(self, path):
+        """React to a change to a builder or the pause file
+
+        :param path: full path that changed
+        """
+        if path == abspath(self.pause_file):
+            if not exists(self.pause_file) and not self.resume.ready():
+                self.resume.send()
+            return
+        for btype, builder_file in self.builder_files.iteritems():
+            if path != abspath(builder_file):
+                continue
+            try:
+                identity = self._builder_identity(btype)
+            except OSError:
+                continue
+            # ignore the builders we write out ourselves
+            if identity != self.known_identity.get(btype):
+                self.wake(btype)
+
+    def _watch_files(self, notifier):
+        """Dispatch inotify events for the builders and pause file"""
+        while True:
+            for path, name, mask in notifier.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    self.handle_event(abspath(self.pause_file))
+                    for btype in self.builder_files:
+                        self.wake(btype)
+                elif path and name:
+                    self.handle_event(pathjoin(path, name))
+
+    def _run_watcher(self, notifier):
+        """Run the inotify watcher, falling back to timers if it fails"""
+        try:
+            self._watch_files(notifier)
+        except Exception:
+            self.logger.exception('inotify watcher failed, falling back to '
+                                  'timers')
+            self.events_active = False
+            notifier.close()
+
+    def _watch_triggers(self, rfd):
+        """Wake every ring when an admin sends us SIGUSR1"""
+        while True:
+            trampoline(rfd, read=True)
+            os.read(rfd, 512)
+            self.logger.notice('-> Trigger received, checking all rings')
+            for btype in self.builder_files:
+                self.wake(btype)
+
+    def start_event_watchers(self):
+        """Start watching for builder changes, the pause file and admin
+        triggers"""
+        rfd, wfd = os.pipe()
+        for fd in (rfd, wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        def _trigger(signum, frame):
+            # only poke the pipe, its not safe to switch greenthreads here
+            try:
+                os.write(wfd, 'x')
+            except OSError:
+                pass
+
+        signal.signal(signal.SIGUSR1, _trigger)
+        spawn_n(self._watch_triggers, rfd)
+        if not self.use_inotify:
+            return
+        paths = set(abspath(f) for f in self.builder_files.values())
+        paths.add(abspath(self.pause_file))
+        try:
+            notifier = Inotify()
+            for path in set(dirname(p) for p in paths):
+                notifier.add_watch(path, IN_CLOSE_WRITE | IN_MOVED_TO |
+                                   IN_MOVED_FROM | IN_CREATE | IN_DELETE)
+        except OSError:
+            self.logger.exception('Unable to use inotify, falling back to '
+                                  'timers')
+            return
+        self.events_active = True
+        spawn_n(self._run_watcher, notifier)
+
     def start(self):
-        """Start up the ring master"""
+        """Start up the ring master, each ring gets its own schedule"""
         self.logger.notice("Ring-Master starting up")
+        self.start_event_watchers()
         self.logger.notice("-> Entering ring orchestration loop.")
-        while True:
-            try:
-                self.pause_if_asked()
-                if self.in_change_window():
-                    for btype in sorted(self.builder_files.keys()):
-                        with lock_parent_directory(self.builder_files[btype],
-                                                   self.lock_timeout):
-                            ring_changed = self.orchestration_pass(btype)
-                        if ring_changed:
-                            sleep(self.recheck_after_change_interval)
-                        else:
-                            sleep(self.recheck_interval)
-                else:
-                    self.logger.debug('Not in change window')
-                    sleep(60)
-            except exceptions.LockTimeout:
-                self.logger.exception('Orchestration LockTimeout Encountered')
-            except Exception:
-                self.logger.exception('Orchestration Error')
-                sleep(60)
-            sleep(1)
+        pool = GreenPool(len(self.builder_files))
+        for btype in sorted(self.builder_files.keys()):
+            pool.spawn_n(self.orchestration_loop, btype)
+        pool.waitall()
 
 
 class RingMasterd(Daemon):
@@ -442,7 +844,7 @@ class RingMasterd(Daemon):
 
 def run_server():
     usage = '''
-    %prog start|stop|restart|pause|unpause [--conf=/path/to/some.conf] [-f]
+    %prog start|stop|restart|pause|unpause|status|trigger [--conf=<conf>] [-f]
     '''
     args = optparse.OptionParser(usage)
     args.add_option('--foreground', '-f', action="store_true",
@@ -477,6 +879,19 @@ def run_server():
             print "Writing pause file"
             with open(pfile, 'w') as f:
                 f.write("")
+        elif 'trigger' == sys.argv[1]:
+            print "Triggering a check of all rings"
+            with open(options.pid) as f:
+                os.kill(int(f.read().strip()), signal.SIGUSR1)
+        elif 'status' == sys.argv[1]:
+            sfile = conf['ringmasterd'].get('status_file', '/tmp/.srm-status')
+            with open(sfile) as f:
+                status = json.load(f)
+            for btype in sorted(status):
+                print "%s: next check %s (%s)" % (
+                    btype, datetime.utcfromtimestamp(
+                        status[btype]['next_check']),
+                    status[btype]['last_result'])
         elif 'unpause':
             print "Removing pause file"
             unlink(pfile)
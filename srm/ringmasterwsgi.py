@@ -1,28 +1,35 @@
+import os
 import sys
+import mmap
 import optparse
-from os import stat
+from errno import EINTR, EEXIST
+from math import ceil, isinf, isnan
+from hashlib import md5
+from os import stat, fstat
 from os.path import exists, join as pathjoin
-from eventlet import wsgi, listen
+from tempfile import mkstemp
+from signal import signal, SIGTERM, SIGINT, SIG_DFL
+from time import time
+from urlparse import parse_qs
+from eventlet import wsgi, listen, sleep, spawn_n, Timeout
+from eventlet.event import Event
 from swift.common.exceptions import LockTimeout
-from swift.common.utils import split_path, readconf, lock_parent_directory
-from srm.utils import Daemon, get_md5sum, get_file_logger
-
-
-class FileIterable(object):
-    def __init__(self, filename):
-        self.filename = filename
-
-    def __iter__(self):
-        return FileIterator(self.filename)
+from swift.common.utils import split_path, readconf, lock_parent_directory, \
+    json, TRUE_VALUES
+from srm.utils import Daemon, get_file_logger, make_ring_delta, TokenBucket, \
+    read_md5_sidecar
+from srm.inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_Q_OVERFLOW
+from srm.sendfile import sendfile, sendfile_available
 
 
 class FileIterator(object):
 
     chunk_size = 4096
 
-    def __init__(self, filename):
-        self.filename = filename
-        self.fileobj = open(self.filename, 'rb')
+    def __init__(self, fileobj, chunk_size=None):
+        self.fileobj = fileobj
+        if chunk_size:
+            self.chunk_size = chunk_size
 
     def __iter__(self):
         return self
@@ -35,6 +42,120 @@ class FileIterator(object):
 
     __next__ = next
 
+    def close(self):
+        self.fileobj.close()
+
+
+class SendfileBody(object):
+    """Send a file straight to the client socket with sendfile(2) so the
+    body never passes through python. The first chunk is handed to the
+    server as normal so it writes out the status line and headers first.
+
+    Only usable with eventlet's server and minimum_write_chunk_size 0, so
+    that first chunk is flushed to the socket before the rest is sent."""
+
+    head_size = 4096
+
+    def __init__(self, fileobj, sock, length, timeout=None):
+        self.fileobj = fileobj
+        self.sock = sock
+        self.length = length
+        self.timeout = timeout
+
+    def __iter__(self):
+        head = self.fileobj.read(self.head_size)
+        if not head:
+            return
+        yield head
+        remaining = self.length - len(head)
+        if remaining > 0:
+            sent = sendfile(self.sock.fileno(), self.fileobj.fileno(),
+                            len(head), remaining, self.timeout)
+            if sent < remaining:
+                # the response is short, the connection has to go
+                raise IOError('%s shrank while being sent'
+                              % self.fileobj.name)
+
+    def close(self):
+        self.fileobj.close()
+
+
+class BufferIterator(object):
+    """Iterate over a buffer (i.e. an mmap) in chunks"""
+
+    def __init__(self, buf, chunk_size=65536):
+        self.buf = buf
+        self.chunk_size = chunk_size
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.offset >= len(self.buf):
+            raise StopIteration
+        chunk = self.buf[self.offset:self.offset + self.chunk_size]
+        self.offset += len(chunk)
+        return chunk
+
+    __next__ = next
+
+
+class TrackedBody(object):
+    """Wrap a response body to get a callback once its been sent"""
+
+    def __init__(self, body, callback):
+        self.body = body
+        self.callback = callback
+        self.finished = False
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if not self.finished:
+                self.finished = True
+                self.callback()
+
+
+class ThrottledBody(object):
+    """Wrap a response body to send it no faster than a TokenBucket
+    allows"""
+
+    def __init__(self, body, bucket, chunk_size=65536):
+        self.body = body
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        for chunk in self.body:
+            for offset in xrange(0, len(chunk), self.chunk_size):
+                piece = chunk[offset:offset + self.chunk_size]
+                self.bucket.consume(len(piece))
+                yield piece
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class RingPayload(object):
+    """In memory copy of a ring file along with its md5 and stat info
+
+    The body is either a str or a read only mmap of the ring file."""
+
+    def __init__(self, body, md5sum, mtime, inode):
+        self.body = body
+        self.md5 = md5sum
+        self.length = len(body)
+        self.mtime = mtime
+        self.inode = inode
+        self.generation = 0
+
 
 class FileLikeLogger(object):
 
@@ -48,52 +169,414 @@ class FileLikeLogger(object):
 class RingMasterApp(object):
     """Ring Master wsgi app to serve up the ring the files"""
 
+    serve_modes = ['memory', 'sendfile', 'iterator']
+
     def __init__(self, conf):
         self.ring_files = ['account.ring.gz', 'container.ring.gz',
                            'object.ring.gz']
         self.swiftdir = conf.get('swiftdir', '/etc/swift')
         self.lock_timeout = float(conf.get('locktimeout', '5'))
+        self.serve_mode = conf.get('serve_mode', 'memory').lower()
+        if self.serve_mode not in self.serve_modes:
+            raise ValueError('Invalid serve_mode: %s' % self.serve_mode)
+        self.sendfile_available = sendfile_available()
+        self.file_chunk_size = int(conf.get('file_chunk_size', '65536'))
+        self.ring_history_size = int(conf.get('ring_history_size', '4'))
+        self.max_delta_ratio = float(conf.get('max_delta_ratio', '0.5'))
+        self.watch_check_interval = float(conf.get('watch_check_interval',
+                                                   '1'))
+        self.watch_max_timeout = float(conf.get('watch_max_timeout', '300'))
+        self.watch_event = Event()
+        self.max_watchers = int(conf.get('max_watchers', '512'))
+        self.active_watchers = 0
+        self.use_inotify = conf.get('use_inotify', 'n') in TRUE_VALUES
+        self.inotify_active = False
+        self.generation = {}
+        self.immutable_max_age = int(conf.get('immutable_max_age',
+                                              '31536000'))
+        self.redirect_immutable = conf.get('redirect_immutable',
+                                           'n') in TRUE_VALUES
+        self.poll_interval_active = int(conf.get('poll_interval_active',
+                                                 '10'))
+        self.poll_interval_idle = int(conf.get('poll_interval_idle', '60'))
+        self.active_window = int(conf.get('active_window', '1800'))
+        self.last_change = 0
+        self.report_expiry = int(conf.get('report_expiry', '3600'))
+        self.max_report_size = int(conf.get('max_report_size', '65536'))
+        # kept on disk so every worker sees every report
+        self.report_dir = conf.get('report_dir',
+                                   pathjoin(self.swiftdir, '.srm-reports'))
+        self.max_reports = int(conf.get('max_reports', '10000'))
+        self.max_downloads = int(conf.get('max_concurrent_downloads', '0'))
+        self.max_send_rate = int(conf.get('max_send_rate', '0'))
+        self.retry_after_max = int(conf.get('retry_after_max', '60'))
+        self.active_downloads = 0
+        self.download_time = 1.0
+        self.workers = int(conf.get('workers', '1'))
+        self.max_clients = int(conf.get('max_clients', '1024'))
+        self.client_timeout = float(conf.get('client_timeout', '60'))
+        self.mmap_rings = conf.get('mmap_rings', 'y' if self.workers > 1
+                                   else 'n') in TRUE_VALUES
         self.wsgi_port = int(conf.get('serve_ring_port', '8090'))
         self.wsgi_address = conf.get('serve_ring_address', '')
         log_path = conf.get('log_path', '/var/log/ring-master/wsgi.log')
         self.logger = get_file_logger('ring-master-wsgi', log_path)
-        self.last_tstamp = {}
         self.current_md5 = {}
+        self.ring_cache = {}
+        self.ring_history = {}
+        self.delta_cache = {}
         for rfile in self.ring_files:
             target_file = pathjoin(self.swiftdir, rfile)
             if exists(target_file):
-                self.last_tstamp[target_file] = stat(target_file).st_mtime
-                self.current_md5[target_file] = get_md5sum(target_file)
-            else:
-                self.last_tstamp[target_file] = None
+                self._update_cache(target_file,
+                                   self._load_payload(target_file))
         self.request_logger = FileLikeLogger(self.logger)
 
+    def _load_payload(self, filename):
+        """Read (or mmap) a ring file into memory
+
+        :param filename: ring file to load
+        :returns: RingPayload for the file
+        """
+        with open(filename, 'rb') as fp:
+            st = fstat(fp.fileno())
+            if self.mmap_rings and st.st_size:
+                # shared with every other process mapping the ring
+                body = mmap.mmap(fp.fileno(), 0, prot=mmap.PROT_READ)
+            else:
+                body = fp.read()
+        md5sum = read_md5_sidecar(filename, st) or md5(body).hexdigest()
+        return RingPayload(body, md5sum, st.st_mtime, st.st_ino)
+
+    def _update_cache(self, filename, payload):
+        """Swap in a new payload for a ring file, retiring the old one to
+        the ring history"""
+        previous = self.ring_cache.get(filename)
+        if previous and previous.md5 != payload.md5 and \
+                self.ring_history_size > 0:
+            history = [p for p in self.ring_history.get(filename, [])
+                       if p.md5 != payload.md5 and p.md5 != previous.md5]
+            history.append(previous)
+            self.ring_history[filename] = history[-self.ring_history_size:]
+        self.delta_cache[filename] = {}
+        self.ring_cache[filename] = payload
+        self.current_md5[filename] = payload.md5
+        if previous and previous.md5 != payload.md5:
+            self.last_change = time()
+        if not previous or previous.md5 != payload.md5:
+            self._notify_watchers()
+
+    def _poll_interval(self):
+        """How often clients should poll for changes. Rings that changed
+        recently are likely to change again soon (i.e. during an
+        orchestration) so clients are asked to check back sooner.
+
+        :returns: Cache-Control header suggesting the poll interval
+        """
+        if time() - self.last_change < self.active_window:
+            interval = self.poll_interval_active
+        else:
+            interval = self.poll_interval_idle
+        return ('Cache-Control', 'max-age=%d' % interval)
+
+    def _notify_watchers(self):
+        """Wake up any requests waiting on a ring change"""
+        event, self.watch_event = self.watch_event, Event()
+        event.send(True)
+
+    def _watch_rings(self):
+        """Periodically revalidate the rings so watchers are woken up
+        on a ring change even if no one requests the ring"""
+        while True:
+            for rfile in self.ring_files:
+                try:
+                    self._validate_file(pathjoin(self.swiftdir, rfile))
+                except (LockTimeout, OSError, IOError):
+                    pass
+                except Exception:
+                    self.logger.exception('Error checking ring for changes')
+            sleep(self.watch_check_interval)
+
+    def _inotify_rings(self, notifier):
+        """Reload rings as soon as inotify reports they've been replaced"""
+        targets = [pathjoin(self.swiftdir, rfile) for rfile in self.ring_files]
+        # start off by prefetching anything that changed before the watch
+        dirty = set(targets)
+        while True:
+            for target in dirty:
+                self.generation[target] = self.generation.get(target, 0) + 1
+            for target in dirty:
+                try:
+                    self._validate_file(target)
+                except (LockTimeout, OSError, IOError):
+                    self.logger.debug('Unable to prefetch %s' % target)
+            dirty = set()
+            for path, name, mask in notifier.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    dirty.update(targets)
+                elif name in self.ring_files:
+                    dirty.add(pathjoin(self.swiftdir, name))
+
+    def _run_inotify(self, notifier):
+        """Run the inotify watcher, falling back to polling if it fails"""
+        try:
+            self._inotify_rings(notifier)
+        except Exception:
+            self.logger.exception('inotify watcher failed, falling back to '
+                                  'polling for ring changes')
+            self.inotify_active = False
+            notifier.close()
+            self._watch_rings()
+
+    def _start_change_watcher(self):
+        """Start watching the rings for changes, using inotify if its
+        enabled and available"""
+        if self.use_inotify:
+            try:
+                notifier = Inotify()
+                notifier.add_watch(self.swiftdir, IN_CLOSE_WRITE | IN_MOVED_TO)
+            except OSError:
+                self.logger.exception('Unable to use inotify')
+            else:
+                # catch anything that changed before the watch was added
+                for rfile in self.ring_files:
+                    target = pathjoin(self.swiftdir, rfile)
+                    self.generation[target] = \
+                        self.generation.get(target, 0) + 1
+                self.inotify_active = True
+                spawn_n(self._run_inotify, notifier)
+                return
+        spawn_n(self._watch_rings)
+
+    def _find_version(self, filename, md5sum):
+        """Find a version of a ring by its md5
+
+        :param filename: ring file
+        :param md5sum: md5 of the version
+        :returns: RingPayload of the version or None if its not in memory
+        """
+        payload = self.ring_cache.get(filename)
+        if payload and payload.md5 == md5sum:
+            return payload
+        for payload in self.ring_history.get(filename, []):
+            if payload.md5 == md5sum:
+                return payload
+        return None
+
+    def _get_delta(self, filename, payload, base_md5):
+        """Get a delta from a previous version of a ring to the current one
+
+        :param filename: ring file
+        :param payload: current RingPayload for the ring
+        :param base_md5: md5 of the ring version the client has
+        :returns: the delta, or None if the base version is unknown or the
+                  delta wouldn't be less than max_delta_ratio of the size of
+                  the ring itself
+        """
+        deltas = self.delta_cache.setdefault(filename, {})
+        if base_md5 in deltas:
+            return deltas[base_md5]
+        for base in self.ring_history.get(filename, []):
+            if base.md5 == base_md5:
+                break
+        else:
+            return None
+        try:
+            delta = make_ring_delta(base.body[:], payload.body[:])
+        except ValueError as err:
+            # i.e. the part power changed, just send the whole thing
+            self.logger.info('No delta for %s from %s: %s'
+                             % (filename, base_md5, err))
+            delta = None
+        except Exception:
+            self.logger.exception('Error building ring delta')
+            delta = None
+        if delta is not None and \
+                len(delta) >= payload.length * self.max_delta_ratio:
+            delta = None
+        deltas[base_md5] = delta
+        return delta
+
     def _changed(self, filename):
-        """Check if files been modified"""
-        current = stat(filename).st_mtime
-        if current == self.last_tstamp[filename]:
+        """Check if files been modified or replaced"""
+        payload = self.ring_cache.get(filename)
+        if self.inotify_active:
+            # the inotify watcher bumps the generation on any change
+            return not payload or \
+                payload.generation != self.generation.get(filename, 0)
+        current = stat(filename)
+        if payload and current.st_mtime == payload.mtime and \
+                current.st_ino == payload.inode:
             return False
         else:
             return True
 
     def _validate_file(self, filename):
-        """Validate md5 of file"""
+        """Validate md5 of file, reloading the cached payload if needed
+
+        :param filename: ring file to validate
+        :returns: current RingPayload for the file
+        """
         if self._changed(filename):
-            self.logger.debug("updating md5")
+            self.logger.debug("updating ring cache")
+            generation = self.generation.get(filename, 0)
             with lock_parent_directory(self.swiftdir, self.lock_timeout):
-                self.last_tstamp[filename] = stat(filename).st_mtime
-                self.current_md5[filename] = get_md5sum(filename)
+                payload = self._load_payload(filename)
+            payload.generation = generation
+            self._update_cache(filename, payload)
+        return self.ring_cache[filename]
+
+    def _payload_body(self, payload, headers):
+        """Build a response body for a ring payload
+
+        :param payload: RingPayload to serve
+        :param headers: response headers, Content-Length is added if needed
+        :returns: body iterable
+        """
+        if isinstance(payload.body, str):
+            return [payload.body]
+        headers.append(('Content-Length', str(payload.length)))
+        return BufferIterator(payload.body, self.file_chunk_size)
+
+    def _file_body(self, env, filename, payload):
+        """Build a file backed response body for a ring
+
+        Uses the servers wsgi.file_wrapper when it has one, or sendfile(2)
+        directly on eventlet's socket, when asked for. Otherwise falls back
+        to a plain FileIterator.
+
+        :param env: wsgi environment
+        :param filename: ring file to serve
+        :param payload: RingPayload the response is being served for
+        :returns: tuple of the body iterable and its length, or (None, None)
+                  if the file on disk no longer matches the payload
+        """
+        fp = open(filename, 'rb')
+        st = fstat(fp.fileno())
+        if st.st_ino != payload.inode or st.st_mtime != payload.mtime:
+            fp.close()
+            return None, None
+        body = None
+        if self.serve_mode == 'sendfile' and not self.max_send_rate:
+            sock = getattr(env.get('wsgi.input'), '_sock', None)
+            if 'wsgi.file_wrapper' in env:
+                body = env['wsgi.file_wrapper'](fp, self.file_chunk_size)
+            elif sock is not None and self.sendfile_available:
+                # get eventlet to flush the headers as soon as it has them
+                env['eventlet.minimum_write_chunk_size'] = 0
+                body = SendfileBody(fp, sock, st.st_size,
+                                    self.client_timeout)
+        if body is None:
+            body = FileIterator(fp, self.file_chunk_size)
+        return body, st.st_size
+
+    def _retry_after(self):
+        """Estimate how long until a download slot frees up"""
+        estimate = int(ceil(self.download_time * self.active_downloads /
+                            self.max_downloads))
+        return max(1, min(estimate, self.retry_after_max))
+
+    @staticmethod
+    def _add_content_length(body, headers):
+        """Add a Content-Length for a list body the server would otherwise
+        work out itself, before its wrapped up"""
+        if isinstance(body, list) and \
+                'Content-Length' not in [h for h, _v in headers]:
+            headers.append(('Content-Length', str(sum(map(len, body)))))
+
+    def _throttle(self, body, headers):
+        """Limit how fast a response body is sent to max_send_rate
+
+        :param body: response body
+        :param headers: response headers, Content-Length is added if needed
+        :returns: wrapped response body
+        """
+        if not self.max_send_rate:
+            return body
+        self._add_content_length(body, headers)
+        chunk_size = min(self.file_chunk_size, self.max_send_rate)
+        return ThrottledBody(body, TokenBucket(self.max_send_rate,
+                                               chunk_size), chunk_size)
+
+    def _track_download(self, body, headers):
+        """Count a full ring download against max_concurrent_downloads
+        until its body has been sent
+
+        :param body: response body
+        :param headers: response headers, Content-Length is added if needed
+        :returns: wrapped response body
+        """
+        if not self.max_downloads:
+            return body
+        self._add_content_length(body, headers)
+        started = time()
+        self.active_downloads += 1
+
+        def _finished():
+            self.active_downloads -= 1
+            self.download_time = \
+                0.8 * self.download_time + 0.2 * (time() - started)
+
+        return TrackedBody(body, _finished)
+
+    def handle_ring_version(self, env, start_response, target, version):
+        """handle requests to /ring/<ring>/<md5>
+
+        Specific versions of a ring never change so they're served with
+        headers that let any http cache hold on to them."""
+        current = self.ring_cache.get(target)
+        if not current or current.md5 != version:
+            # it may be a version thats been published since we last looked
+            try:
+                self._validate_file(target)
+            except (LockTimeout, OSError, IOError):
+                self.logger.exception('Unable to check %s for changes'
+                                      % target)
+        payload = self._find_version(target, version)
+        if not payload:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found\r\n']
+        cache_control = 'public, max-age=%d, immutable' % \
+            self.immutable_max_age
+        if env.get('HTTP_IF_NONE_MATCH') == payload.md5:
+            start_response('304 Not Modified',
+                           [('Content-Type', 'application/octet-stream'),
+                            ('Cache-Control', cache_control)])
+            return []
+        headers = [('Content-Type', 'application/octet-stream'),
+                   ('Etag', payload.md5), ('Cache-Control', cache_control)]
+        if env['REQUEST_METHOD'] == 'HEAD':
+            start_response('200 OK', headers)
+            return []
+        elif env['REQUEST_METHOD'] != 'GET':
+            start_response('501 Not Implemented', [('Content-Type',
+                                                    'text/plain')])
+            return ['Not Implemented\r\n']
+        if self.max_downloads and \
+                self.active_downloads >= self.max_downloads:
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain'),
+                            ('Retry-After', str(self._retry_after()))])
+            return ['Service Unavailable\r\n']
+        body = self._track_download(
+            self._throttle(self._payload_body(payload, headers), headers),
+            headers)
+        start_response('200 OK', headers)
+        return body
 
     def handle_ring(self, env, start_response):
         """handle requests to /ring"""
-        base, ringfile = split_path(env['PATH_INFO'], minsegs=1, maxsegs=2,
-                                    rest_with_last=True)
+        base, ringfile, version = split_path(env['PATH_INFO'], minsegs=1,
+                                             maxsegs=3, rest_with_last=True)
         if ringfile not in self.ring_files:
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return ['Not Found\r\n']
         target = pathjoin(self.swiftdir, ringfile)
+        if version:
+            return self.handle_ring_version(env, start_response, target,
+                                            version)
         try:
-            self._validate_file(target)
+            payload = self._validate_file(target)
         except LockTimeout:
             self.logger.exception('swiftdir locked for update')
             start_response('503 Service Unavailable',
@@ -104,19 +587,53 @@ class RingMasterApp(object):
             start_response('503 Service Unavailable',
                            [('Content-Type', 'text/plain')])
             return ['Service Unavailable\r\n']
+        location = '/ring/%s/%s' % (ringfile, payload.md5)
         if 'HTTP_IF_NONE_MATCH' in env:
-            if env['HTTP_IF_NONE_MATCH'] == self.current_md5[target]:
-                headers = [('Content-Type', 'application/octet-stream')]
+            if env['HTTP_IF_NONE_MATCH'] == payload.md5:
+                headers = [('Content-Type', 'application/octet-stream'),
+                           self._poll_interval()]
                 start_response('304 Not Modified', headers)
-                return ['Not Modified\r\n']
+                return []
         if env['REQUEST_METHOD'] == 'GET':
+            base_md5 = parse_qs(env.get('QUERY_STRING', '')).get('from')
+            if base_md5:
+                delta = self._get_delta(target, payload, base_md5[0])
+                if delta is not None:
+                    headers = [('Content-Type',
+                                'application/x-srm-ring-delta'),
+                               ('Etag', payload.md5),
+                               ('X-Ring-Delta-Base', base_md5[0])]
+                    body = self._throttle([delta], headers)
+                    start_response('200 OK', headers)
+                    return body
+            if self.redirect_immutable:
+                start_response('302 Found', [('Content-Type', 'text/plain'),
+                                             ('Location', location)])
+                return ['Found\r\n']
+            if self.max_downloads and \
+                    self.active_downloads >= self.max_downloads:
+                start_response('503 Service Unavailable',
+                               [('Content-Type', 'text/plain'),
+                                ('Retry-After', str(self._retry_after()))])
+                return ['Service Unavailable\r\n']
             headers = [('Content-Type', 'application/octet-stream')]
-            headers.append(('Etag', self.current_md5[target]))
+            headers.append(('Etag', payload.md5))
+            headers.append(('Content-Location', location))
+            body = None
+            if self.serve_mode != 'memory':
+                body, length = self._file_body(env, target, payload)
+                if body is not None:
+                    headers.append(('Content-Length', str(length)))
+            if body is None:
+                body = self._payload_body(payload, headers)
+            body = self._track_download(self._throttle(body, headers),
+                                        headers)
             start_response('200 OK', headers)
-            return FileIterable(target)
+            return body
         elif env['REQUEST_METHOD'] == 'HEAD':
             headers = [('Content-Type', 'application/octet-stream')]
-            headers.append(('Etag', self.current_md5[target]))
+            headers.append(('Etag', payload.md5))
+            headers.append(('Content-Location', location))
             start_response('200 OK', headers)
             return []
         else:
@@ -124,17 +641,426 @@ class RingMasterApp(object):
                                                     'text/plain')])
             return ['Not Implemented\r\n']
 
+    def _changed_rings(self, known):
+        """Find which rings differ from the versions a client knows about
+
+        :param known: dict of ring type to the md5 the client has
+        :returns: dict of ring type to current md5 for all rings in known if
+                  any of them changed, otherwise an empty dict
+        """
+        current = {}
+        for ring_type in known:
+            target = pathjoin(self.swiftdir, '%s.ring.gz' % ring_type)
+            try:
+                current[ring_type] = self._validate_file(target).md5
+            except (LockTimeout, OSError, IOError):
+                current[ring_type] = self.current_md5.get(target, '')
+        for ring_type in known:
+            if known[ring_type] != current[ring_type]:
+                return current
+        return {}
+
+    def handle_watch(self, env, start_response):
+        """handle requests to /watch
+
+        Blocks until one of the requested rings no longer matches the md5
+        given for it or the timeout expires. Once max_watchers requests are
+        already waiting new ones get a 503 and should go back to polling."""
+        if env['REQUEST_METHOD'] != 'GET':
+            start_response('501 Not Implemented', [('Content-Type',
+                                                    'text/plain')])
+            return ['Not Implemented\r\n']
+        params = parse_qs(env.get('QUERY_STRING', ''), keep_blank_values=True)
+        known = {}
+        for ring_file in self.ring_files:
+            ring_type = ring_file.split('.')[0]
+            if ring_type in params:
+                known[ring_type] = params[ring_type][0]
+        try:
+            timeout = min(float(params.get('timeout', ['30'])[0]),
+                          self.watch_max_timeout)
+        except ValueError:
+            timeout = None
+        if not known or timeout is None:
+            start_response('400 Bad Request', [('Content-Type',
+                                                'text/plain')])
+            return ['Bad Request\r\n']
+        changed = self._changed_rings(known)
+        if changed:
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(changed)]
+        if self.max_watchers and self.active_watchers >= self.max_watchers:
+            # every watcher holds a connection, leave some for downloads
+            retry_after = max(1, min(self.poll_interval_active,
+                                     self.retry_after_max))
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain'),
+                            ('Retry-After', str(retry_after))])
+            return ['Service Unavailable\r\n']
+        deadline = time() + timeout
+        self.active_watchers += 1
+        try:
+            while True:
+                event = self.watch_event
+                changed = self._changed_rings(known)
+                if changed:
+                    start_response('200 OK', [('Content-Type',
+                                               'application/json')])
+                    return [json.dumps(changed)]
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                with Timeout(remaining, False):
+                    event.wait()
+        finally:
+            self.active_watchers -= 1
+        start_response('304 Not Modified', [('Content-Type', 'text/plain')])
+        return []
+
+    def handle_manifest(self, env, start_response):
+        """handle requests to /rings
+
+        Returns the md5, size and mtime of every ring being served along
+        with an Etag for the manifest as a whole."""
+        if env['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('501 Not Implemented', [('Content-Type',
+                                                    'text/plain')])
+            return ['Not Implemented\r\n']
+        manifest = {}
+        for rfile in self.ring_files:
+            try:
+                payload = self._validate_file(pathjoin(self.swiftdir, rfile))
+            except (LockTimeout, OSError, IOError):
+                continue
+            manifest[rfile] = {'md5': payload.md5, 'size': payload.length,
+                               'mtime': payload.mtime}
+        etag = md5(''.join('%s:%s\n' % (rfile, manifest[rfile]['md5'])
+                           for rfile in sorted(manifest))).hexdigest()
+        if env.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', [('Content-Type',
+                                                 'application/json'),
+                                                self._poll_interval()])
+            return []
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Etag', etag), self._poll_interval()])
+        if env['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [json.dumps(manifest, separators=(',', ':'))]
+
+    def handle_report(self, env, start_response):
+        """handle requests to /report
+
+        Minions POST the md5 of each ring they have installed, when they
+        installed it and how long the install took."""
+        if env['REQUEST_METHOD'] != 'POST':
+            start_response('501 Not Implemented', [('Content-Type',
+                                                    'text/plain')])
+            return ['Not Implemented\r\n']
+        try:
+            length = int(env.get('CONTENT_LENGTH') or 0)
+            if length > self.max_report_size:
+                raise ValueError('Report too large')
+            report = json.loads(env['wsgi.input'].read(length))
+            hostname = report['hostname']
+            rings = {}
+            for rfile, info in report['rings'].iteritems():
+                if rfile in self.ring_files:
+                    latency = info.get('install_latency')
+                    if latency is not None:
+                        latency = self._check_duration(latency)
+                    rings[rfile] = {
+                        'md5': str(info['md5']),
+                        'installed': self._check_duration(info['installed']),
+                        'install_latency': latency}
+            if not isinstance(hostname, basestring) or not hostname:
+                raise ValueError('Invalid hostname')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            start_response('400 Bad Request', [('Content-Type',
+                                                'text/plain')])
+            return ['Bad Request\r\n']
+        try:
+            if not exists(self._report_path(hostname)) and \
+                    self._expire_reports() >= self.max_reports:
+                # only new hosts add to the table so only they're refused
+                self.logger.warning('Already have %d reports, refusing '
+                                    'report from %s'
+                                    % (self.max_reports, hostname))
+                start_response('503 Service Unavailable',
+                               [('Content-Type', 'text/plain')])
+                return ['Service Unavailable\r\n']
+            self._save_report(hostname, rings)
+        except (OSError, IOError):
+            self.logger.exception('Unable to save report from %s' % hostname)
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain')])
+            return ['Service Unavailable\r\n']
+        start_response('204 No Content', [])
+        return []
+
+    @staticmethod
+    def _check_duration(value):
+        """Make sure a reported time is a sensible number, they get sorted
+        together and python 2 will happily sort strings in with numbers
+
+        :param value: reported value
+        :returns: value as a float
+        :raises ValueError: if the value isn't a finite non-negative number
+        """
+        if isinstance(value, bool) or not isinstance(value, (int, long,
+                                                             float)):
+            raise ValueError('Not a number')
+        value = float(value)
+        if isnan(value) or isinf(value) or value < 0:
+            raise ValueError('Not a finite non-negative number')
+        return value
+
+    def _report_path(self, hostname):
+        """Get the path a host's report is kept in
+
+        :param hostname: host the report is from
+        :returns: path to the report file
+        """
+        if isinstance(hostname, unicode):
+            hostname = hostname.encode('utf-8')
+        return pathjoin(self.report_dir,
+                        md5(hostname).hexdigest() + '.report')
+
+    def _save_report(self, hostname, rings):
+        """Save a host's report, replacing any earlier one from it
+
+        :param hostname: host the report is from
+        :param rings: dict of the ring info it reported, by ring file
+        """
+        try:
+            os.mkdir(self.report_dir)
+        except OSError as err:
+            if err.errno != EEXIST:
+                raise
+        fd, tmppath = mkstemp(dir=self.report_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(json.dumps({'hostname': hostname, 'rings': rings}))
+            os.rename(tmppath, self._report_path(hostname))
+        except Exception:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+    def _expire_reports(self):
+        """Remove reports older than report_expiry
+
+        :returns: number of reports left
+        """
+        try:
+            names = os.listdir(self.report_dir)
+        except OSError:
+            return 0
+        now = time()
+        count = 0
+        for name in names:
+            path = pathjoin(self.report_dir, name)
+            try:
+                if now - stat(path).st_mtime > self.report_expiry:
+                    os.unlink(path)
+                elif name.endswith('.report'):
+                    count += 1
+            except OSError:
+                continue
+        return count
+
+    def _load_reports(self):
+        """Load the latest report from each host, removing any that are
+        older than report_expiry
+
+        :returns: dict of reports by hostname, each with the rings reported
+                  and when the report was made
+        """
+        reports = {}
+        try:
+            names = os.listdir(self.report_dir)
+        except OSError:
+            return reports
+        now = time()
+        for name in names:
+            path = pathjoin(self.report_dir, name)
+            try:
+                reported = stat(path).st_mtime
+                if now - reported > self.report_expiry:
+                    os.unlink(path)
+                    continue
+                if not name.endswith('.report'):
+                    continue
+                with open(path, 'rb') as fp:
+                    report = json.loads(fp.read())
+                reports[report['hostname']] = {'rings': report['rings'],
+                                               'reported': reported}
+            except (OSError, IOError, ValueError, KeyError, TypeError):
+                # i.e. expired and removed by another worker
+                continue
+        return reports
+
+    @staticmethod
+    def _percentiles(values):
+        """Summarize a list of numbers
+
+        :returns: dict of p50, p90, p99 and max, or None for no values
+        """
+        if not values:
+            return None
+        values = sorted(values)
+        summary = {'max': values[-1]}
+        for pct in (50, 90, 99):
+            rank = int(ceil(pct / 100.0 * len(values))) - 1
+            summary['p%d' % pct] = values[max(rank, 0)]
+        return summary
+
+    def handle_convergence(self, env, start_response):
+        """handle requests to /status/convergence
+
+        Returns how many of the reporting minions have the current version
+        of each ring, along with how long the current version took to
+        reach them (since it was written out) and how long their installs
+        took."""
+        if env['REQUEST_METHOD'] != 'GET':
+            start_response('501 Not Implemented', [('Content-Type',
+                                                    'text/plain')])
+            return ['Not Implemented\r\n']
+        reports = self._load_reports()
+        status = {}
+        for rfile in self.ring_files:
+            target = pathjoin(self.swiftdir, rfile)
+            try:
+                payload = self._validate_file(target)
+            except (LockTimeout, OSError, IOError):
+                continue
+            lagging = []
+            propagation = []
+            install_latency = []
+            for hostname, report in reports.iteritems():
+                info = report['rings'].get(rfile)
+                if not info or info['md5'] != payload.md5:
+                    lagging.append(hostname)
+                    continue
+                propagation.append(max(info['installed'] - payload.mtime,
+                                       0))
+                if info['install_latency'] is not None:
+                    install_latency.append(info['install_latency'])
+            hosts = len(reports)
+            converged = len(propagation)
+            status[rfile] = {
+                'md5': payload.md5, 'hosts': hosts, 'converged': converged,
+                'pct': 100.0 * converged / hosts if hosts else 0.0,
+                'propagation_latency': self._percentiles(propagation),
+                'install_latency': self._percentiles(install_latency),
+                'lagging': sorted(lagging)}
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(status)]
+
     def handle_request(self, env, start_response):
         if env['PATH_INFO'].startswith('/ring/'):
             return self.handle_ring(env, start_response)
+        elif env['PATH_INFO'] == '/watch':
+            return self.handle_watch(env, start_response)
+        elif env['PATH_INFO'] == '/rings':
+            return self.handle_manifest(env, start_response)
+        elif env['PATH_INFO'] == '/report':
+            return self.handle_report(env, start_response)
+        elif env['PATH_INFO'] == '/status/convergence':
+            return self.handle_convergence(env, start_response)
         else:
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return ['Not Found\r\n']
 
-    def start(self):
-        """fire up the app"""
-        wsgi.server(listen((self.wsgi_address, self.wsgi_port)),
-                    self.handle_request, log=self.request_logger)
+    def __call__(self, env, start_response):
+        status = []
+
+        def _start_response(code, headers, exc_info=None):
+            status.append(code)
+            if exc_info:
+                return start_response(code, headers, exc_info)
+            return start_response(code, headers)
+
+        body = self.handle_request(env, _start_response)
+        if env['REQUEST_METHOD'] == 'HEAD' or \
+                (status and status[-1][:3] in ('204', '304')):
+            # eventlet writes out whatever we give it, and a body the
+            # client doesn't expect poisons a kept alive connection
+            if hasattr(body, 'close'):
+                body.close()
+            return []
+        return body
+
+    def _serve(self, sock):
+        """Serve requests on sock in this process"""
+        self._start_change_watcher()
+        wsgi.server(sock, self, log=self.request_logger,
+                    max_size=self.max_clients,
+                    socket_timeout=self.client_timeout)
+
+    def _spawn_worker(self, sock):
+        """Fork off a worker process to serve requests on sock
+
+        :returns: pid of the worker
+        """
+        pid = os.fork()
+        if pid == 0:
+            signal(SIGTERM, SIG_DFL)
+            signal(SIGINT, SIG_DFL)
+            try:
+                self._serve(sock)
+            except Exception:
+                self.logger.exception('Worker died')
+            finally:
+                os._exit(0)
+        return pid
+
+    def _run_workers(self, sock):
+        """Pre-fork workers sharing the listen socket and restart any
+        that die"""
+        children = {}
+
+        def _stop(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, SIGTERM)
+                except OSError:
+                    pass
+            sys.exit(0)
+
+        signal(SIGTERM, _stop)
+        signal(SIGINT, _stop)
+        while True:
+            while len(children) < self.workers:
+                pid = self._spawn_worker(sock)
+                children[pid] = time()
+                self.logger.info('Started worker %d' % pid)
+            try:
+                pid, status = os.wait()
+            except OSError, err:
+                if err.errno == EINTR:
+                    continue
+                raise
+            if pid in children:
+                started = children.pop(pid)
+                self.logger.error('Worker %d exited with status %d, '
+                                  'restarting' % (pid, status))
+                if time() - started < 1:
+                    # don't fork bomb if workers die right away
+                    sleep(1)
+
+    def start(self, sock=None):
+        """fire up the app
+
+        :param sock: listen socket to serve on, instead of opening our own
+        """
+        if sock is None:
+            sock = listen((self.wsgi_address, self.wsgi_port))
+        if self.workers > 1:
+            self._run_workers(sock)
+        else:
+            self._serve(sock)
 
 
 class RingMasterAppd(Daemon):
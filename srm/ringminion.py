@@ -3,14 +3,27 @@ ring-minion
 """
 import os
 import sys
+import urllib
 import urllib2
+import shlex
+import signal
 import optparse
-from time import sleep
-from random import choice
+from hashlib import md5
+from time import time
+from random import choice, uniform
+from socket import gethostname
 from tempfile import mkstemp
+from shutil import copyfile
+from cStringIO import StringIO
 from os.path import basename, dirname, join as pathjoin, exists
-from swift.common.utils import get_logger, readconf, TRUE_VALUES
-from srm.utils import Daemon, get_md5sum, md5matches, is_valid_ring
+from eventlet import sleep, spawn_n, listen, monkey_patch, GreenPool, \
+    Timeout
+from eventlet.green import subprocess
+from swift.common.utils import get_logger, readconf, TRUE_VALUES, json
+from srm.utils import Daemon, md5matches, is_valid_ring, \
+    apply_ring_delta, get_ring_md5, write_md5_sidecar, KeepAliveHandler, \
+    TokenBucket, build_green_opener, remove_md5_sidecar
+from srm.ringmasterwsgi import RingMasterApp
 
 
 class RingMinion(object):
@@ -29,8 +42,75 @@ class RingMinion(object):
                                                   'object.ring.gz'))}
         self.start_delay = int(conf.get('start_delay_range', '120'))
         self.check_interval = int(conf.get('check_interval', '30'))
-        self.ring_master = conf.get('ring_master', 'http://127.0.0.1:8090/')
+        self.min_check_interval = int(conf.get('min_check_interval', '5'))
+        self.max_check_interval = int(conf.get('max_check_interval', '600'))
+        self.use_poll_hints = conf.get('use_poll_hints', 'y') in TRUE_VALUES
+        self.poll_hint = None
+        self.failures = 0
+        self.ring_masters = [m.strip() for m in
+                             conf.get('ring_master',
+                                      'http://127.0.0.1:8090/').split(',')
+                             if m.strip()]
+        self.ring_master = self.ring_masters[0]
         self.ring_master_timeout = int(conf.get('ring_master_timeout', '30'))
+        self.failover_timeout = int(conf.get('failover_timeout', '5'))
+        self.endpoint_error_suppression = int(
+            conf.get('endpoint_error_suppression', '60'))
+        self.endpoints = dict(
+            (m, {'latency': None, 'errors': 0, 'retry_at': 0})
+            for m in self.ring_masters)
+        self.failed_this_pass = set()
+        self.delta_downloads = conf.get('delta_downloads', 'y') in TRUE_VALUES
+        self.fetch_concurrency = int(conf.get('fetch_concurrency', '3'))
+        self.read_chunk_size = int(conf.get('read_chunk_size', '65536'))
+        self.max_download_rate = int(conf.get('max_download_rate', '0'))
+        if self.max_download_rate:
+            # don't let a single read blow through the limit
+            self.read_chunk_size = min(self.read_chunk_size,
+                                       self.max_download_rate)
+        # shared by all downloads so the limit covers the whole minion
+        self.download_bucket = TokenBucket(self.max_download_rate)
+        self.keepalive_idle = int(conf.get('keepalive_idle_timeout', '30'))
+        if conf.get('keepalive', 'y') in TRUE_VALUES:
+            self.keepalive = KeepAliveHandler(
+                idle_timeout=self.keepalive_idle)
+        else:
+            self.keepalive = None
+        # rings are fetched concurrently from green threads so the sockets
+        # need to be green whether or not they're kept alive
+        urllib2.install_opener(build_green_opener(self.keepalive))
+        self.busy_retries = int(conf.get('busy_retries', '3'))
+        self.use_manifest = conf.get('use_manifest', 'y') in TRUE_VALUES
+        self.manifest = None
+        self.manifest_etag = None
+        self.watch_mode = conf.get('watch_mode', 'n') in TRUE_VALUES
+        self.watch_timeout = int(conf.get('watch_timeout', '300'))
+        self.ring_store_dir = conf.get('ring_store_dir',
+                                       pathjoin(self.swiftdir, '.ring-store'))
+        self.ring_store_size = int(conf.get('ring_store_size', '4'))
+        self.notify_command = shlex.split(conf.get('notify_command', ''))
+        self.notify_timeout = float(conf.get('notify_timeout', '30'))
+        self.notify_pid_files = [p.strip() for p in
+                                 conf.get('notify_pid_files', '').split(',')
+                                 if p.strip()]
+        notify_signal = conf.get('notify_signal', 'HUP').upper()
+        if not notify_signal.startswith('SIG'):
+            notify_signal = 'SIG' + notify_signal
+        self.notify_signal = getattr(signal, notify_signal)
+        self.report_status = conf.get('report_status', 'y') in TRUE_VALUES
+        self.report_to = conf.get('report_to', '')
+        self.hostname = conf.get('hostname', gethostname())
+        self.install_latency = {}
+        self.relay_enabled = conf.get('relay', 'n') in TRUE_VALUES
+        self.relay_conf = {
+            'swiftdir': self.swiftdir,
+            'serve_ring_port': conf.get('relay_port', '8090'),
+            'serve_ring_address': conf.get('relay_address', ''),
+            'log_path': conf.get('relay_log_path',
+                                 '/var/log/ring-minion/relay.log'),
+            'max_concurrent_downloads': conf.get('relay_max_downloads', '0'),
+            'workers': '1'}
+        self.relay = None
         self.debug = conf.get('debug', 'n') in TRUE_VALUES
         if self.debug:
             conf['log_level'] = 'DEBUG'
@@ -41,25 +121,35 @@ class RingMinion(object):
         for ring in self.rings:
             if exists(self.rings[ring]):
                 self.current_md5[self.rings[ring]] = \
-                    get_md5sum(self.rings[ring])
+                    get_ring_md5(self.rings[ring])
             else:
                 self.current_md5[self.rings[ring]] = ''
 
-    def _write_ring(self, response, ring_type):
-        """Write the ring out to a tmp file
+    def _write_ring(self, response, ring_type, expected_md5=None,
+                    throttle=True):
+        """Write the ring out to a tmp file, hashing it as it arrives
 
         :param response: The urllib2 response to read from
         :param ring_type: The ring type we're working on
+        :param expected_md5: md5 the ring should have, checked before the
+                             ring is synced to disk
+        :param throttle: Limit reads to max_download_rate
         :returns: path to tmp ring file"""
         tmp = dirname(pathjoin(self.swiftdir, ring_type))
         fd, tmppath = mkstemp(dir=tmp, suffix='.tmp')
         try:
             with os.fdopen(fd, 'wb') as fdo:
+                digest = md5()
                 while True:
-                    chunk = response.read(4096)
+                    chunk = response.read(self.read_chunk_size)
                     if not chunk:
                         break
+                    if throttle:
+                        self.download_bucket.consume(len(chunk))
+                    digest.update(chunk)
                     fdo.write(chunk)
+                if expected_md5 and digest.hexdigest() != expected_md5:
+                    raise Exception('md5 missmatch')
                 fdo.flush()
                 os.fsync(fdo)
         except Exception:
@@ -68,51 +158,322 @@ class RingMinion(object):
             raise
         return tmppath
 
+    def _write_delta_ring(self, response, ring_type):
+        """Rebuild a ring from a delta against our current ring (or one in
+        the ring store) and write it out to a tmp file
+
+        :param response: The urllib2 response to read the delta from
+        :param ring_type: The ring type we're working on
+        :returns: path to tmp ring file"""
+        base_md5 = response.headers.get('x-ring-delta-base')
+        ring_file = self.rings[ring_type]
+        if base_md5 != self.current_md5[ring_file]:
+            ring_file = self._store_path(ring_type, base_md5)
+        with open(ring_file, 'rb') as fp:
+            base = fp.read()
+        if md5(base).hexdigest() != base_md5:
+            raise Exception('Delta base md5 missmatch')
+        delta = []
+        while True:
+            chunk = response.read(self.read_chunk_size)
+            if not chunk:
+                break
+            self.download_bucket.consume(len(chunk))
+            delta.append(chunk)
+        ring = apply_ring_delta(base, ''.join(delta))
+        return self._write_ring(StringIO(ring), ring_type,
+                                response.headers.get('etag'), throttle=False)
+
     @staticmethod
-    def _validate_ring(tmppath, expected_md5):
-        """Make sure the ring is actually valid"""
-        if not md5matches(tmppath, expected_md5):
+    def _validate_ring(tmppath, expected_md5=None):
+        """Make sure the ring is actually valid
+
+        :param tmppath: ring file to check
+        :param expected_md5: md5 to check the file against, if it wasn't
+                             already checked while it was written"""
+        if expected_md5 and not md5matches(tmppath, expected_md5):
             raise Exception('md5 missmatch')
         if not is_valid_ring(tmppath):
             raise Exception('Invalid ring')
 
+    def _store_path(self, ring_type, md5sum):
+        """Path of a ring version in the local ring store"""
+        return pathjoin(self.ring_store_dir, basename(self.rings[ring_type]),
+                        basename(md5sum))
+
+    def _stored_versions(self, ring_type):
+        """List the versions of a ring in the ring store
+
+        :returns: list of md5s, most recently installed first"""
+        store = dirname(self._store_path(ring_type, 'x'))
+        try:
+            versions = [(os.stat(pathjoin(store, f)).st_mtime, f)
+                        for f in os.listdir(store) if not f.endswith('.tmp')]
+        except OSError:
+            return []
+        return [f for _mtime, f in sorted(versions, reverse=True)]
+
+    def _store_ring(self, tmppath, ring_type, md5sum):
+        """Keep a copy of a validated ring in the ring store, dropping the
+        oldest versions beyond ring_store_size"""
+        if not self.ring_store_size:
+            return
+        store_path = self._store_path(ring_type, md5sum)
+        try:
+            if exists(store_path):
+                os.utime(store_path, None)
+            else:
+                if not exists(dirname(store_path)):
+                    os.makedirs(dirname(store_path))
+                copyfile(tmppath, store_path + '.tmp')
+                os.rename(store_path + '.tmp', store_path)
+            for old in self._stored_versions(ring_type)[self.ring_store_size:]:
+                os.unlink(self._store_path(ring_type, old))
+        except (IOError, OSError):
+            self.logger.exception('Unable to add %s ring to the ring store'
+                                  % ring_type)
+
+    def install_from_store(self, ring_type, md5sum):
+        """Install a version of a ring from the ring store, no download
+        needed (i.e. when the ring master rolls back to a ring we've had)
+
+        :param ring_type: Ring to install object|container|account
+        :param md5sum: md5 of the version to install
+        :returns: True if the ring was installed"""
+        store_path = self._store_path(ring_type, md5sum)
+        if not self.ring_store_size or not exists(store_path):
+            return False
+        started = time()
+        tmp_ring_path = None
+        try:
+            with open(store_path, 'rb') as fp:
+                tmp_ring_path = self._write_ring(fp, ring_type, md5sum,
+                                                 throttle=False)
+            self._validate_ring(tmp_ring_path)
+            self._move_in_place(tmp_ring_path, ring_type, md5sum)
+        except Exception:
+            self.logger.exception('Unable to install %s ring from the ring '
+                                  'store' % ring_type)
+            for path in (tmp_ring_path, store_path):
+                try:
+                    if path:
+                        os.unlink(path)
+                except OSError:
+                    pass
+            return False
+        self.install_latency[self.rings[ring_type]] = time() - started
+        self.logger.info('Installed %s ring %s from the ring store'
+                         % (ring_type, md5sum))
+        return True
+
     def _move_in_place(self, tmppath, ring_type, expected_md5):
         """Move the tmp ring into place"""
         os.chmod(tmppath, 0644)
+        self._store_ring(tmppath, ring_type, expected_md5)
+        try:
+            write_md5_sidecar(self.rings[ring_type], expected_md5, tmppath)
+        except (IOError, OSError):
+            self.logger.exception('Unable to write md5 sidecar')
+            remove_md5_sidecar(self.rings[ring_type])
         os.rename(tmppath, self.rings[ring_type])
         self.current_md5[self.rings[ring_type]] = expected_md5
 
-    def fetch_ring(self, ring_type):
+    @staticmethod
+    def _get_retry_after(err):
+        """Get the Retry-After from a 503 response, if there is one
+
+        :param err: urllib2.HTTPError
+        :returns: seconds to wait or None"""
+        if err.code != 503 or not err.hdrs:
+            return None
+        try:
+            return max(0, int(err.hdrs.get('retry-after')))
+        except (TypeError, ValueError):
+            return None
+
+    def _record_success(self, ring_master, elapsed):
+        """Track how quickly a ring master answered us
+
+        :param ring_master: the ring master
+        :param elapsed: seconds it took to get a response"""
+        stats = self.endpoints[ring_master]
+        if stats['latency'] is None:
+            stats['latency'] = elapsed
+        else:
+            stats['latency'] = 0.7 * stats['latency'] + 0.3 * elapsed
+        stats['errors'] = 0
+        stats['retry_at'] = 0
+
+    def _record_error(self, ring_master):
+        """Track a ring master failing us, leaving it out of rotation for a
+        while that grows with consecutive errors"""
+        stats = self.endpoints[ring_master]
+        stats['errors'] += 1
+        stats['retry_at'] = time() + min(
+            self.endpoint_error_suppression * 2 ** (stats['errors'] - 1),
+            self.endpoint_error_suppression * 16)
+
+    def _ranked_ring_masters(self):
+        """Rank the ring masters, fastest healthy ones first. Ones we
+        haven't heard from yet keep their configured order ahead of ones
+        we have, and ring masters that recently failed go last.
+
+        :returns: list of ring masters"""
+        now = time()
+        healthy = [m for m in self.ring_masters
+                   if self.endpoints[m]['retry_at'] <= now]
+        failed = [m for m in self.ring_masters if m not in healthy]
+        healthy.sort(key=lambda m: self.endpoints[m]['latency'] or 0)
+        failed.sort(key=lambda m: self.endpoints[m]['retry_at'])
+        return healthy + failed
+
+    def _request_timeout(self):
+        """Timeout to use talking to the current ring master. Its shorter
+        when theres another ring master we could fail over to instead."""
+        for ring_master in self.ring_masters:
+            if ring_master != self.ring_master and \
+                    ring_master not in self.failed_this_pass:
+                return min(self.failover_timeout, self.ring_master_timeout)
+        return self.ring_master_timeout
+
+    def _next_ring_master(self, failed):
+        """Fail over to the next best ring master, if theres one left to
+        try this pass
+
+        :param failed: the ring master that failed us
+        :returns: True if we failed over, False if there are none left"""
+        if failed not in self.failed_this_pass:
+            self.failed_this_pass.add(failed)
+            self._record_error(failed)
+        if failed != self.ring_master:
+            # another ring fetch already failed over
+            return True
+        for ring_master in self._ranked_ring_masters():
+            if ring_master not in self.failed_this_pass:
+                self.ring_master = ring_master
+                self.logger.warning('Failing over to ring master %s'
+                                    % self.ring_master)
+                return True
+        return False
+
+    @staticmethod
+    def _get_max_age(headers):
+        """Get the max-age from a response's Cache-Control header
+
+        :param headers: response headers
+        :returns: max-age in seconds or None"""
+        if not headers:
+            return None
+        for directive in (headers.get('cache-control') or '').split(','):
+            name, _junk, value = directive.strip().partition('=')
+            if name.lower() == 'max-age':
+                try:
+                    return max(0, int(value))
+                except ValueError:
+                    return None
+        return None
+
+    def _record_poll_hint(self, headers):
+        """Remember how often the ring master wants us to poll"""
+        max_age = self._get_max_age(headers)
+        if self.use_poll_hints and max_age is not None:
+            self.poll_hint = min(max(max_age, self.min_check_interval),
+                                 self.max_check_interval)
+
+    def next_check_interval(self):
+        """How long to wait before the next pass. Follows the ring master's
+        hint when theres one, and backs off exponentially (with jitter) from
+        check_interval while passes keep failing.
+
+        :returns: seconds to wait"""
+        if self.failures:
+            backoff = min(self.check_interval * 2 ** self.failures,
+                          self.max_check_interval)
+            return uniform(backoff / 2.0, backoff)
+        if self.poll_hint is not None:
+            return self.poll_hint
+        return self.check_interval
+
+    def fetch_ring(self, ring_type, allow_delta=True, attempt=0):
         """Fetch a new ring if theres one available
 
         :param ring_type: Ring to fetch object|container|account
-        :returns: True on ring change, None for no change, False for error"""
+        :param allow_delta: Ask for a delta against our current ring
+        :param attempt: Number of times the ring master has told us to retry
+        :returns: True on ring change, None for no change (or the ring master
+                  being too busy), False for error"""
+        started = time()
         try:
             tmp_ring_path = None
+            ring_master = self.ring_master
             url = "%sring/%s" % (
-                self.ring_master, basename(self.rings[ring_type]))
-            headers = {'If-None-Match': self.current_md5[
-                self.rings[ring_type]]}
+                ring_master, basename(self.rings[ring_type]))
+            current_md5 = self.current_md5[self.rings[ring_type]]
+            if allow_delta and self.delta_downloads:
+                # without a current ring use our newest stored one as a base
+                base_md5 = current_md5 or \
+                    (self._stored_versions(ring_type) or [''])[0]
+                if base_md5:
+                    url += '?from=%s' % base_md5
+            headers = {'If-None-Match': current_md5}
             self.logger.debug("Checking on %s ring" % (ring_type))
             request = urllib2.Request(url, headers=headers)
-            response = urllib2.urlopen(
-                request, timeout=self.ring_master_timeout)
+            try:
+                response = urllib2.urlopen(request,
+                                           timeout=self._request_timeout())
+            except urllib2.HTTPError, e:
+                if e.code == 304:
+                    self._record_success(ring_master, time() - started)
+                raise
+            self._record_success(ring_master, time() - started)
             if not response.code == 200:
                 self.logger.warning('Received non 200 status code')
                 return False
-            tmp_ring_path = self._write_ring(response, ring_type)
-            self._validate_ring(tmp_ring_path, response.headers.get('etag'))
+            if not response.headers.get('etag'):
+                raise Exception('No Etag for %s ring' % ring_type)
+            if response.headers.get('x-ring-delta-base'):
+                try:
+                    tmp_ring_path = self._write_delta_ring(response,
+                                                           ring_type)
+                    self._validate_ring(tmp_ring_path)
+                except Exception:
+                    self.logger.exception('Error applying ring delta. '
+                                          'Retrying with full ring.')
+                    if tmp_ring_path:
+                        os.unlink(tmp_ring_path)
+                    return self.fetch_ring(ring_type, allow_delta=False)
+            else:
+                tmp_ring_path = self._write_ring(
+                    response, ring_type, response.headers.get('etag'))
+                self._validate_ring(tmp_ring_path)
             self._move_in_place(tmp_ring_path, ring_type,
                                 response.headers.get('etag'))
+            self.install_latency[self.rings[ring_type]] = time() - started
         except urllib2.HTTPError, e:
             if e.code == 304:
                 self.logger.debug('Ring-master reports ring unchanged.')
+                self._record_poll_hint(e.hdrs)
                 return None
+            retry_after = self._get_retry_after(e)
+            if retry_after is not None:
+                if attempt >= self.busy_retries:
+                    self.logger.info('Ring-master busy, deferring %s ring '
+                                     'to the next pass' % ring_type)
+                    return None
+                delay = retry_after + uniform(0, retry_after or 1)
+                self.logger.info('Ring-master busy, retrying %s ring in '
+                                 '%.1fs' % (ring_type, delay))
+                sleep(delay)
+                return self.fetch_ring(ring_type, allow_delta, attempt + 1)
             else:
                 self.logger.exception('Error communicating with ring-master')
+                if self._next_ring_master(ring_master):
+                    return self.fetch_ring(ring_type, allow_delta, attempt)
                 return False
         except urllib2.URLError:
             self.logger.exception('Error communicating with ring-master')
+            if self._next_ring_master(ring_master):
+                return self.fetch_ring(ring_type, allow_delta, attempt)
             return False
         except Exception:
             if tmp_ring_path:
@@ -124,37 +485,294 @@ class RingMinion(object):
             return False
         return True
 
+    def fetch_manifest(self):
+        """Fetch the md5, size and mtime of all rings from the ring master
+
+        :returns: dict of ring file name to ring info, or None on error"""
+        headers = {}
+        if self.manifest_etag:
+            headers['If-None-Match'] = self.manifest_etag
+        ring_master = self.ring_master
+        try:
+            request = urllib2.Request("%srings" % ring_master,
+                                      headers=headers)
+            started = time()
+            try:
+                response = urllib2.urlopen(request,
+                                           timeout=self._request_timeout())
+            except urllib2.HTTPError, e:
+                if e.code == 304:
+                    self._record_success(ring_master, time() - started)
+                raise
+            self._record_success(ring_master, time() - started)
+            if not response.code == 200:
+                self.logger.warning('Received non 200 status code')
+                return None
+            self.manifest = json.loads(response.read())
+            self.manifest_etag = response.headers.get('etag')
+            self._record_poll_hint(response.headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                self.logger.debug('Ring-master reports manifest unchanged.')
+                self._record_poll_hint(e.hdrs)
+                return self.manifest
+            self.logger.exception('Error fetching ring manifest')
+            if self._next_ring_master(ring_master):
+                return self.fetch_manifest()
+            return None
+        except urllib2.URLError:
+            self.logger.exception('Error fetching ring manifest')
+            if self._next_ring_master(ring_master):
+                return self.fetch_manifest()
+            return None
+        except Exception:
+            self.logger.exception('Error fetching ring manifest')
+            return None
+        return self.manifest
+
+    def check_rings(self):
+        """Check all the rings for changes, only fetching the rings that
+        the ring master's manifest shows as changed when its available.
+
+        :returns: dict of ring type to fetch_ring style result"""
+        # start every pass on the best ring master
+        self.failed_this_pass = set()
+        self.ring_master = self._ranked_ring_masters()[0]
+        manifest = None
+        if self.use_manifest:
+            manifest = self.fetch_manifest()
+        results = {}
+        to_fetch = []
+        for ring_type in self.rings:
+            if manifest is not None:
+                ring_file = self.rings[ring_type]
+                info = manifest.get(basename(ring_file))
+                if info and info['md5'] == self.current_md5[ring_file]:
+                    self.logger.debug("%s ring unchanged in manifest"
+                                      % ring_type)
+                    results[ring_type] = None
+                    continue
+                if info and self.install_from_store(ring_type, info['md5']):
+                    results[ring_type] = True
+                    continue
+            to_fetch.append(ring_type)
+        pool = GreenPool(self.fetch_concurrency)
+        for ring_type, result in zip(to_fetch,
+                                     pool.imap(self._check_ring, to_fetch)):
+            results[ring_type] = result
+        return results
+
+    def _check_ring(self, ring_type):
+        """Fetch a single ring, keeping any errors to that ring
+
+        :returns: fetch_ring style result"""
+        try:
+            return self.fetch_ring(ring_type)
+        except Exception:
+            self.logger.exception('Error checking on %s ring' % ring_type)
+            return False
+
+    def send_report(self):
+        """Tell the ring master which version of each ring we have
+        installed, when it was installed and how long the install took
+
+        :returns: True if the report was sent"""
+        rings = {}
+        for ring_file in self.rings.values():
+            if not self.current_md5[ring_file]:
+                continue
+            try:
+                installed = os.stat(ring_file).st_mtime
+            except OSError:
+                continue
+            rings[basename(ring_file)] = {
+                'md5': self.current_md5[ring_file], 'installed': installed,
+                'install_latency': self.install_latency.get(ring_file)}
+        report = json.dumps({'hostname': self.hostname, 'rings': rings})
+        try:
+            request = urllib2.Request(
+                '%sreport' % (self.report_to or self.ring_master),
+                data=report, headers={'Content-Type': 'application/json'})
+            urllib2.urlopen(request, timeout=self._request_timeout()).read()
+        except Exception:
+            self.logger.debug('Unable to report status to ring-master',
+                              exc_info=True)
+            return False
+        return True
+
+    def notify_services(self, ring_types):
+        """Let local services know about newly installed rings. Called once
+        per pass with everything installed in that pass so services get a
+        single notification no matter how many rings changed.
+
+        Runs notify_command (with the updated ring files in the
+        SRM_UPDATED_RINGS environment variable) and/or sends notify_signal
+        to the pids in notify_pid_files.
+
+        :param ring_types: ring types installed this pass
+        :returns: True if everything was notified"""
+        if not ring_types or not (self.notify_command or
+                                  self.notify_pid_files):
+            return True
+        ring_files = sorted(self.rings[r] for r in ring_types)
+        success = True
+        if self.notify_command:
+            env = dict(os.environ, SRM_UPDATED_RINGS=','.join(ring_files))
+            proc = None
+            try:
+                proc = subprocess.Popen(self.notify_command, env=env)
+                with Timeout(self.notify_timeout):
+                    status = proc.wait()
+                if status != 0:
+                    self.logger.error('notify_command exited with status %s'
+                                      % status)
+                    success = False
+            except Timeout:
+                self.logger.error('notify_command timed out')
+                try:
+                    proc.kill()
+                except OSError:
+                    pass  # it finished on its own after all
+                # reap it so it doesn't linger as a zombie
+                proc.wait()
+                success = False
+            except OSError:
+                self.logger.exception('Unable to run notify_command')
+                success = False
+        for pid_file in self.notify_pid_files:
+            try:
+                with open(pid_file) as fp:
+                    os.kill(int(fp.read().strip()), self.notify_signal)
+            except (IOError, OSError, ValueError):
+                self.logger.exception('Unable to signal pid in %s' % pid_file)
+                success = False
+        try:
+            installed = min(os.stat(r).st_mtime for r in ring_files)
+            self.logger.info('Notified local services of %s ring changes '
+                             '%.3fs after install'
+                             % (', '.join(sorted(ring_types)),
+                                time() - installed))
+        except OSError:
+            pass
+        return success
+
+    def wait_for_change(self):
+        """Block on the ring master's watch api until a ring changes
+
+        :returns: True if a ring changed, False if the watch timed out with
+                  no change, None on error"""
+        params = {'timeout': self.watch_timeout}
+        for ring_type in self.rings:
+            params[ring_type] = self.current_md5[self.rings[ring_type]]
+        url = "%swatch?%s" % (self.ring_master, urllib.urlencode(params))
+        try:
+            self.logger.debug("Watching for ring changes")
+            response = urllib2.urlopen(
+                url, timeout=self.watch_timeout + self.ring_master_timeout)
+            if response.code == 200:
+                response.read()
+                return True
+            self.logger.warning('Received unexpected status code from '
+                                'watch: %s' % response.code)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return False
+            self.logger.exception('Error watching ring-master')
+        except Exception:
+            self.logger.exception('Error watching ring-master')
+        return None
+
+    def wait_for_next_pass(self):
+        """Wait until its time to check on the rings again"""
+        if self.watch_mode and not self.failures:
+            if self.wait_for_change() is not None:
+                return
+            self.logger.info('Watch failed, falling back to polling')
+        interval = self.next_check_interval()
+        if self.keepalive and interval >= self.keepalive_idle:
+            # don't hold a connection (and a ring master greenthread) open
+            # for the whole wait
+            self.keepalive.close_idle()
+        sleep(interval)
+
+    def start_relay(self):
+        """Re-serve the rings we've validated and installed to other minions
+        using the ring master's /ring/ api, so they can use us as their
+        ring_master and fan out from the real ring master becomes a tree.
+
+        :returns: True if the relay was started, False if it couldn't be and
+                  relaying has been disabled
+        """
+        # the relay runs in a green thread next to the minion so make sure
+        # talking to the ring master doesn't block it
+        monkey_patch(socket=True)
+        sock = None
+        try:
+            log_dir = dirname(self.relay_conf['log_path'])
+            if log_dir and not exists(log_dir):
+                os.makedirs(log_dir)
+            sock = listen((self.relay_conf['serve_ring_address'],
+                           int(self.relay_conf['serve_ring_port'])))
+            relay = RingMasterApp(self.relay_conf)
+        except Exception:
+            # a broken relay shouldn't stop us keeping our own rings current
+            self.logger.exception('Unable to start relay on port %s, '
+                                  'relaying disabled'
+                                  % self.relay_conf['serve_ring_port'])
+            if sock:
+                sock.close()
+            self.relay_enabled = False
+            return False
+        self.relay = relay
+        spawn_n(self.relay.start, sock)
+        self.logger.info('Relaying rings on port %s'
+                         % self.relay_conf['serve_ring_port'])
+        return True
+
     def watch_loop(self):
         """Start monitoring ring files for changes"""
+        if self.relay_enabled and not self.relay:
+            self.start_relay()
         # insert a random delay on startup so we don't flood the server
         sleep(choice(range(self.start_delay)))
         while True:
             try:
-                for ring in self.rings:
-                    changed = self.fetch_ring(ring)
+                results = self.check_rings()
+                for ring, changed in results.iteritems():
                     if changed:
                         self.logger.info("%s updated" % ring)
                     elif changed is False:
                         self.logger.info("%s check/change failed!!" % ring)
                     elif changed is None:
                         self.logger.debug("%s remains unchanged" % ring)
+                if False in results.values():
+                    self.failures += 1
+                else:
+                    self.failures = 0
+                self.notify_services([r for r in results if results[r]])
+                if self.report_status:
+                    self.send_report()
             except Exception:
+                self.failures += 1
                 try:
                     self.logger.exception('Error in watch loop')
                 except Exception:
                     print "Got exception and exception while trying to log"
-            sleep(self.check_interval)
+            self.wait_for_next_pass()
 
     def once(self):
         """Just check for changes once."""
-        for ring in self.rings:
-            changed = self.fetch_ring(ring)
+        results = self.check_rings()
+        for ring, changed in results.iteritems():
             if changed:
                 print "%s ring updated" % ring
             elif changed is False:
                 print "%s ring change failed" % ring
             elif changed is None:
                 print "%s ring remains unchanged" % ring
+        self.notify_services([r for r in results if results[r]])
+        if self.report_status:
+            self.send_report()
 
 
 class RingMiniond(Daemon):
@@ -170,6 +788,8 @@ class RingMiniond(Daemon):
             except Exception as err:
                 # just in case
                 print err
+                # don't spin if watch_loop keeps blowing up straight away
+                sleep(minion.check_interval)
 
 
 def run_server():
@@ -0,0 +1,68 @@
+"""
+Ring balance stats shared by the ring master's checks
+"""
+from weakref import WeakKeyDictionary
+
+# what swift reports for a device with no weight that still has partitions
+MAX_BALANCE = 999.99
+
+_stats_cache = WeakKeyDictionary()
+
+
+class RingStats(object):
+    """Partition counts, wanted partitions and balance for each device in a
+    builder, worked out the same way swift's RingBuilder.get_balance does
+    from the partition counts the builder keeps for each device."""
+
+    def __init__(self, builder):
+        devs = [dev for dev in builder.devs if dev is not None]
+        self.parts = dict((dev['id'], dev['parts']) for dev in devs)
+        total_weight = sum(dev['weight'] for dev in devs)
+        if total_weight:
+            weight_of_one_part = \
+                float(builder.parts * builder.replicas) / total_weight
+        else:
+            weight_of_one_part = 0
+        self.wanted = dict((dev['id'], dev['weight'] * weight_of_one_part)
+                           for dev in devs)
+        self.balance_per_dev = {}
+        for dev in devs:
+            if not dev['weight']:
+                if self.parts[dev['id']]:
+                    balance = MAX_BALANCE
+                else:
+                    balance = 0
+            else:
+                balance = 100.0 * self.parts[dev['id']] / \
+                    self.wanted[dev['id']] - 100.0
+            self.balance_per_dev[dev['id']] = balance
+        self.balance = max([abs(b) for b in self.balance_per_dev.values()]
+                           or [0])
+
+
+def _generation(builder):
+    """Something that changes whenever a builders balance might have
+
+    :param builder: builder to check
+    :returns: a hashable generation marker
+    """
+    return (getattr(builder, 'version', None), builder.parts,
+            builder.replicas,
+            tuple((dev['id'], dev['weight'], dev['parts'])
+                  for dev in builder.devs if dev))
+
+
+def get_stats(builder):
+    """Get the stats for a builder, only working them out again if the
+    builder has changed since the last time we were asked
+
+    :param builder: builder to get the stats for
+    :returns: RingStats for the builder
+    """
+    generation = _generation(builder)
+    cached = _stats_cache.get(builder)
+    if cached and cached[0] == generation:
+        return cached[1]
+    stats = RingStats(builder)
+    _stats_cache[builder] = (generation, stats)
+    return stats
@@ -0,0 +1,68 @@
+"""
+Minimal ctypes sendfile(2) binding that cooperates with eventlet
+"""
+import os
+import ctypes
+import ctypes.util
+import socket
+from errno import EAGAIN, EINTR
+from eventlet.hubs import trampoline
+
+_libc_sendfile = None
+
+
+def _load_sendfile():
+    global _libc_sendfile
+    if _libc_sendfile is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        func = libc.sendfile64
+        func.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        func.restype = ctypes.c_ssize_t
+        _libc_sendfile = func
+    return _libc_sendfile
+
+
+def sendfile_available():
+    """Check if sendfile can be used on this host
+
+    :returns: True if sendfile is available
+    """
+    try:
+        _load_sendfile()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def sendfile(out_fd, in_fd, offset, count, timeout=None):
+    """Send count bytes of a file to a (non blocking) socket, green
+    waiting whenever the socket is full
+
+    :param out_fd: socket file descriptor to send to
+    :param in_fd: file descriptor to send from
+    :param offset: where in the file to start
+    :param count: number of bytes to send
+    :param timeout: seconds to wait for the socket to be writable
+    :returns: number of bytes sent, less than count if the file was short
+    :raises: socket.timeout if the socket wasn't writable in time
+    """
+    func = _load_sendfile()
+    pos = ctypes.c_int64(offset)
+    total = 0
+    while total < count:
+        sent = func(out_fd, in_fd, ctypes.byref(pos), count - total)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err == EAGAIN:
+                trampoline(out_fd, write=True, timeout=timeout,
+                           timeout_exc=socket.timeout('timed out'))
+                continue
+            if err == EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        if sent == 0:
+            break
+        total += sent
+    return total
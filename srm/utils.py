@@ -3,17 +3,28 @@ Random utils
 """
 from hashlib import md5
 from os import mkdir
-from swift.common.utils import drop_privileges
+from tempfile import mkstemp
+from swift.common.utils import drop_privileges, json
 from swift.common.ring import Ring
-from os.path import basename, join as pathjoin
+from os.path import basename, dirname, join as pathjoin
 from shutil import copy
 from errno import EEXIST
 import sys
 import os
+import zlib
+from binascii import hexlify, unhexlify
+from gzip import GzipFile
+from array import array
+import struct
 import atexit
+import socket
+import urllib2
 import smtplib
 import eventlet 
-from signal import SIGTERM
+from eventlet.green import httplib as green_httplib
+import resource
+import cPickle as pickle
+from signal import SIGTERM, SIGKILL
 from time import time, sleep
 # logging doesn't import patched as cleanly as one would like
 from logging.handlers import SysLogHandler, TimedRotatingFileHandler
@@ -86,6 +97,78 @@ def get_md5sum(filename, chunk_size=4096):
     return md5sum.hexdigest()
 
 
+def write_md5_sidecar(filename, md5sum, source=None):
+    """Atomically publish the md5 of a file in a sidecar next to it
+
+    The sidecar records the size, mtime and inode of the file so readers can
+    tell when it has gone stale. Since a rename keeps all three, the sidecar
+    can be written for a tmp file before it is renamed over filename.
+
+    :param filename: file the md5 belongs to
+    :param md5sum: md5 of the file
+    :param source: file to take the size/mtime/inode from, defaults to
+                   filename
+    """
+    st = os.stat(source or filename)
+    info = {'md5': md5sum, 'size': st.st_size, 'mtime': st.st_mtime,
+            'inode': st.st_ino}
+    fd, tmppath = mkstemp(dir=dirname(filename), suffix='.tmp.md5')
+    try:
+        with os.fdopen(fd, 'wb') as fdo:
+            fdo.write(json.dumps(info))
+            fdo.flush()
+            os.fsync(fdo)
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, filename + '.md5')
+    except Exception:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+def remove_md5_sidecar(filename):
+    """Remove the md5 sidecar for a file, i.e. when a new one couldn't be
+    written, so nobody is told the md5 of a version that's been replaced
+
+    :param filename: file the sidecar belongs to
+    """
+    try:
+        os.unlink(filename + '.md5')
+    except OSError:
+        pass
+
+
+def read_md5_sidecar(filename, st=None):
+    """Get the md5 of a file from its sidecar if the sidecar is current
+
+    :param filename: file to get the md5 of
+    :param st: stat result for filename, if the caller already has one
+    :returns: hex digest of file or None if the sidecar is missing or stale
+    """
+    try:
+        with open(filename + '.md5', 'rb') as fp:
+            info = json.loads(fp.read())
+        if st is None:
+            st = os.stat(filename)
+    except (IOError, OSError, ValueError):
+        return None
+    if info.get('size') != st.st_size or info.get('mtime') != st.st_mtime \
+            or info.get('inode') != st.st_ino:
+        return None
+    return info.get('md5')
+
+
+def get_ring_md5(filename):
+    """Get the md5 of a file, using its sidecar when possible
+
+    :param filename: file to get the md5 of
+    :returns: hex digest of file
+    """
+    return read_md5_sidecar(filename) or get_md5sum(filename)
+
+
 def md5matches(target_file, expected_md5):
     """Check if a file matches an md5sum
 
@@ -115,13 +198,83 @@ def make_backup(filename, backup_dir):
     return [backup, get_md5sum(backup)]
 
 
-def is_valid_ring(ring_file):
+def _check_ring_structure(ring_file, chunk_size=65536):
+    """Check the structure of a v1 ring file without loading all of it
+
+    Parses the header and device table then streams the replica to
+    partition to device tables through in chunks, making sure they're the
+    right shape and only point at devices that exist.
+
+    :param ring_file: ring file to check
+    :param chunk_size: number of device ids to check at a time
+    :returns: True or False if the ring is valid, None if the ring isn't in
+              the v1 format (including newer versions of the R1NG format)
+    """
+    gz_file = GzipFile(ring_file, 'rb')
+    try:
+        if gz_file.read(4) != 'R1NG':
+            return None
+        version, = struct.unpack('!H', gz_file.read(2))
+        if version != 1:
+            # a newer format, leave it to swift's Ring to decide
+            return None
+        json_len, = struct.unpack('!I', gz_file.read(4))
+        ring_dict = json.loads(gz_file.read(json_len))
+        dev_ids = set(dev['id'] for dev in ring_dict['devs'] if dev)
+        if not dev_ids:
+            return False
+        replica_count = int(ring_dict['replica_count'])
+        part_shift = int(ring_dict['part_shift'])
+        if replica_count < 1 or not 0 <= part_shift < 32:
+            return False
+        partition_count = 1 << (32 - part_shift)
+        if partition_count < 2:
+            return False
+        byteswap = ring_dict.get('byteorder', sys.byteorder) != sys.byteorder
+        for replica in xrange(replica_count):
+            remaining = partition_count
+            while remaining:
+                count = min(remaining, chunk_size)
+                data = gz_file.read(2 * count)
+                if len(data) % 2:
+                    return False
+                part2dev = array('H', data)
+                if byteswap:
+                    part2dev.byteswap()
+                if not dev_ids.issuperset(part2dev):
+                    return False
+                remaining -= len(part2dev)
+                if len(part2dev) < count:
+                    # only the last replica can be short
+                    if replica != replica_count - 1 or \
+                            remaining == partition_count:
+                        return False
+                    break
+        # reading to the end also checks the gzip crc
+        if gz_file.read(1):
+            return False
+    finally:
+        gz_file.close()
+    return True
+
+
+def is_valid_ring(ring_file, strict=False):
     """Check if a ring file is 'valid'
         - make sure it has more than one device
         - make sure get_part_nodes works
+    By default the ring's structure is checked in a single streaming pass,
+    strict loads the full ring instead. Rings not in the v1 format are
+    always fully loaded.
+
+    :param ring_file: ring file to check
+    :param strict: load the full ring to check it
     :returns: True or False if ring is valid
     """
     try:
+        if not strict:
+            valid = _check_ring_structure(ring_file)
+            if valid is not None:
+                return valid
         ring = Ring(ring_file)
         if len(ring.devs) < 1:
             return False
@@ -132,6 +285,413 @@ def is_valid_ring(ring_file):
     return True
 
 
+RING_DELTA_MAGIC = 'SRMD'
+RING_DELTA_VERSION = 2
+
+
+def _gzip_header_length(data):
+    """Find the length of the gzip member header at the start of data
+
+    :param data: gzip file contents
+    :returns: offset of the start of the deflate stream
+    """
+    if data[:3] != '\x1f\x8b\x08':
+        raise ValueError('Not a gzip file')
+    flags = ord(data[3])
+    offset = 10
+    if flags & 4:  # FEXTRA
+        offset += 2 + struct.unpack('<H', data[offset:offset + 2])[0]
+    if flags & 8:  # FNAME
+        offset = data.index('\x00', offset) + 1
+    if flags & 16:  # FCOMMENT
+        offset = data.index('\x00', offset) + 1
+    if flags & 2:  # FHCRC
+        offset += 2
+    return offset
+
+
+def _gunzip(data):
+    """Decompress a single member gzip file
+
+    :param data: gzip file contents
+    :returns: tuple of the gzip header and the decompressed contents
+    """
+    header_len = _gzip_header_length(data)
+    return data[:header_len], zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+        data[header_len:])
+
+
+def _ring_table_offset(raw):
+    """Find where the replica to partition to device tables start in a
+    decompressed v1 ring
+
+    :param raw: decompressed ring contents
+    :returns: offset of the first replica2part2dev table
+    """
+    if raw[:4] != 'R1NG' or struct.unpack('!H', raw[4:6])[0] != 1:
+        raise ValueError('Not a v1 ring')
+    json_len, = struct.unpack('!I', raw[6:10])
+    return 10 + json_len
+
+
+def _xor_strings(a, b):
+    """XOR two equal length strings together
+
+    :param a: first string
+    :param b: second string
+    :returns: a XOR b
+    """
+    if not a:
+        return ''
+    # long does the work in C, a python loop over a big ring blocks the hub
+    result = long(hexlify(a), 16) ^ long(hexlify(b), 16)
+    return unhexlify('%0*x' % (2 * len(a), result))
+
+
+def make_ring_delta(base, target):
+    """Build a binary delta between two gzipped ring files
+
+    The device list and the rest of the ring's metadata are sent as they
+    are, the replica to partition to device tables are XORed against the
+    base's. A rebalance only moves a small fraction of partitions, so that
+    leaves almost nothing but zeros which compress down to next to nothing
+    however the moved partitions are spread about.
+
+    :param base: contents of the ring file the client already has
+    :param target: contents of the ring file the client wants
+    :returns: the delta as a string
+    :raises ValueError: if the rings aren't v1 rings with the same number of
+                        partitions and replicas
+    """
+    base_raw = _gunzip(base)[1]
+    target_header, target_raw = _gunzip(target)
+    base_table = base_raw[_ring_table_offset(base_raw):]
+    table_offset = _ring_table_offset(target_raw)
+    target_table = target_raw[table_offset:]
+    if len(base_table) != len(target_table):
+        raise ValueError('Ring tables differ in size')
+    body = zlib.compress(''.join([struct.pack('!I', table_offset),
+                                  target_raw[:table_offset],
+                                  _xor_strings(base_table, target_table)]))
+    return ''.join([struct.pack('!4sBI', RING_DELTA_MAGIC, RING_DELTA_VERSION,
+                                len(target_header)), target_header, body])
+
+
+def apply_ring_delta(base, delta):
+    """Rebuild a gzipped ring file from a base ring file and a delta
+
+    The result is recompressed the way swift writes rings, callers must
+    still check its md5 since a different zlib may not give identical bytes.
+
+    :param base: contents of the ring file the delta was made against
+    :param delta: delta from make_ring_delta
+    :returns: contents of the target ring file
+    """
+    magic, version, header_len = struct.unpack('!4sBI', delta[:9])
+    if magic != RING_DELTA_MAGIC or version != RING_DELTA_VERSION:
+        raise ValueError('Unknown ring delta format')
+    target_header = delta[9:9 + header_len]
+    body = zlib.decompress(delta[9 + header_len:])
+    table_offset, = struct.unpack('!I', body[:4])
+    prefix = body[4:4 + table_offset]
+    table = body[4 + table_offset:]
+    if len(prefix) != table_offset:
+        raise ValueError('Truncated ring delta')
+    base_raw = _gunzip(base)[1]
+    base_table = base_raw[_ring_table_offset(base_raw):]
+    if len(base_table) != len(table):
+        raise ValueError('Ring delta doesn\'t match its base')
+    target_raw = prefix + _xor_strings(base_table, table)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                  zlib.DEF_MEM_LEVEL, 0)
+    return ''.join([target_header, compressor.compress(target_raw),
+                    compressor.flush(),
+                    struct.pack('<II', zlib.crc32(target_raw) & 0xffffffff,
+                                len(target_raw) & 0xffffffff)])
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter, i.e. for bytes per second
+
+    :param rate: tokens added per second, 0 for no limit
+    :param burst: most tokens that can build up, defaults to one second's
+                  worth
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time()
+
+    def consume(self, amount):
+        """Take amount tokens from the bucket, (green) sleeping until
+        they've been earned if the bucket is running a deficit
+
+        :param amount: tokens to take
+        :returns: seconds slept
+        """
+        if not self.rate:
+            return 0
+        now = time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        delay = -self.tokens / self.rate
+        eventlet.sleep(delay)
+        return delay
+
+
+class _PooledResponse(object):
+    """File like wrapper around an httplib response that hands its
+    connection back to the pool once the response has been fully read"""
+
+    def __init__(self, resp, release):
+        self.resp = resp
+        self._release = release
+        self._check_done()
+
+    def _check_done(self):
+        if self._release and self.resp.isclosed():
+            release, self._release = self._release, None
+            release(True)
+
+    def read(self, amt=None):
+        data = self.resp.read(amt)
+        self._check_done()
+        return data
+
+    def readline(self):
+        line = []
+        while True:
+            char = self.read(1)
+            line.append(char)
+            if not char or char == '\n':
+                return ''.join(line)
+
+    def close(self):
+        if self._release:
+            # not fully read, so the connection can't be reused
+            release, self._release = self._release, None
+            self.resp.close()
+            release(False)
+
+
+class GreenHTTPHandler(urllib2.HTTPHandler):
+    """urllib2 handler that makes a new green http connection per request,
+    so concurrent requests from green threads don't block each other"""
+
+    def http_open(self, req):
+        return self.do_open(green_httplib.HTTPConnection, req)
+
+
+class GreenHTTPSHandler(urllib2.HTTPSHandler):
+    """urllib2 handler for https using green connections"""
+
+    def https_open(self, req):
+        return self.do_open(green_httplib.HTTPSConnection, req)
+
+
+def build_green_opener(http_handler=None):
+    """Build a urllib2 opener whose connections are all green
+
+    :param http_handler: handler to use for http, i.e. a KeepAliveHandler,
+                         defaults to a GreenHTTPHandler
+    :returns: urllib2 opener
+    """
+    handlers = [http_handler or GreenHTTPHandler()]
+    if hasattr(green_httplib, 'HTTPSConnection'):
+        handlers.append(GreenHTTPSHandler())
+    return urllib2.build_opener(*handlers)
+
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """urllib2 handler that keeps http connections open and reuses them
+    for later requests to the same host, instead of paying for a new
+    connection per request. Connections are green so concurrent requests
+    from green threads don't block each other."""
+
+    def __init__(self, max_idle=8, idle_timeout=30):
+        urllib2.HTTPHandler.__init__(self)
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+
+    def _get_connection(self, host, timeout):
+        """Get an idle connection to host or a new one
+
+        :returns: tuple of connection and whether its being reused"""
+        self.close_idle(self.idle_timeout)
+        conns = self.idle.get(host)
+        if conns:
+            conn = conns.pop()[0]
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        return green_httplib.HTTPConnection(host, timeout=timeout), False
+
+    def _put_connection(self, host, conn, reuse):
+        """Return a connection to the pool, or close it"""
+        conns = self.idle.setdefault(host, [])
+        if reuse and len(conns) < self.max_idle:
+            conns.append((conn, time()))
+        else:
+            conn.close()
+
+    def close_idle(self, older_than=0):
+        """Close pooled connections so they don't tie up the server
+
+        :param older_than: only close connections that have been idle for
+                           more than this many seconds
+        """
+        cutoff = time() - older_than
+        for host, conns in self.idle.items():
+            for conn, idle_since in list(conns):
+                if idle_since <= cutoff:
+                    conns.remove((conn, idle_since))
+                    conn.close()
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = dict((k.title(), v) for k, v in headers.items())
+        headers['Connection'] = 'keep-alive'
+        while True:
+            conn, reused = self._get_connection(host, req.timeout)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+                resp = conn.getresponse()
+                break
+            except (socket.error, green_httplib.HTTPException), err:
+                conn.close()
+                if not reused:
+                    raise urllib2.URLError(err)
+                # the server probably closed an idle connection on us,
+                # try again on another one
+
+        if resp.status in (204, 304) or 100 <= resp.status < 200 or \
+                req.get_method() == 'HEAD':
+            # httplib won't read a body for these, so if the server sent
+            # one anyway it'd be left on the socket and mistaken for the
+            # next response. Only reuse the connection if the server says
+            # there isn't one.
+            safe = resp.getheader('content-length') == '0'
+        else:
+            safe = True
+
+        def release(reuse):
+            self._put_connection(host, conn,
+                                 reuse and safe and not resp.will_close)
+
+        if resp.length == 0:
+            # nothing to read (304, HEAD, etc) so we're done with it now
+            resp.read()
+        result = urllib2.addinfourl(_PooledResponse(resp, release), resp.msg,
+                                    req.get_full_url())
+        result.code = resp.status
+        result.msg = resp.reason
+        return result
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _address_space_size():
+    """Get the current size of this process's address space
+
+    :returns: size in bytes, or 0 if it can't be found
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+    return pages * resource.getpagesize()
+
+
+def run_in_child(func, args=(), timeout=None, memory_limit=0, tmpdir=None,
+                 poll_interval=0.1):
+    """Run a function in a forked child process and get back its result.
+    The parent (green) sleeps while it waits so it stays responsive.
+
+    :param func: function to run, its return value must be picklable
+    :param args: arguments to call func with
+    :param timeout: seconds to let the child run before killing it, None
+                    to wait forever
+    :param memory_limit: how much the child may grow its address space by
+                         in bytes (on top of what it inherits from us), 0
+                         for no limit
+    :param tmpdir: where to put the file the result is passed back in
+    :param poll_interval: how often to check if the child is done
+    :returns: what func returned
+    :raises: whatever func raised, or WorkerError if the child timed out
+             or died without a result
+    """
+    fd, result_path = mkstemp(dir=tmpdir, suffix='.tmp.result')
+    os.close(fd)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if memory_limit:
+                    # the child starts out with everything we've got mapped
+                    # so only count what func adds to that
+                    limit = _address_space_size() + memory_limit
+                    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+                try:
+                    result = (True, func(*args))
+                except Exception as err:
+                    result = (False, err)
+                with open(result_path, 'wb') as f:
+                    try:
+                        pickle.dump(result, f, protocol=2)
+                    except (pickle.PicklingError, TypeError):
+                        f.seek(0)
+                        f.truncate()
+                        pickle.dump((False, WorkerError(repr(result[1]))), f,
+                                    protocol=2)
+                status = 0
+            finally:
+                os._exit(status)
+        started = time()
+        while True:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid:
+                break
+            if timeout is not None and time() - started > timeout:
+                os.kill(pid, SIGKILL)
+                os.waitpid(pid, 0)
+                raise WorkerError('Worker %d timed out after %ds'
+                                  % (pid, timeout))
+            eventlet.sleep(poll_interval)
+        if os.WIFSIGNALED(status):
+            raise WorkerError('Worker %d killed by signal %d'
+                              % (pid, os.WTERMSIG(status)))
+        try:
+            with open(result_path, 'rb') as f:
+                success, result = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            raise WorkerError('Worker %d exited (%d) without a result'
+                              % (pid, os.WEXITSTATUS(status)))
+        if not success:
+            raise result
+        return result
+    finally:
+        try:
+            os.unlink(result_path)
+        except OSError:
+            pass
+
+
 # http://www.jejik.com/articles/2007/02/a_simple_unix_linux_daemon_in_python/
 
 
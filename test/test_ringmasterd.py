@@ -2,14 +2,20 @@ import os
 import time
 import subprocess  # to patch
 import json
+import mmap
+import signal
+import eventlet
 import unittest
 import cPickle as pickle
 from shutil import rmtree
 from tempfile import mkdtemp
 from swift.common import utils
-from swift.common.ring import RingBuilder
+from swift.common.ring import RingBuilder, RingData
+from swift.common.exceptions import RingBuilderError, LockTimeout
 from mock import patch, Mock, MagicMock, call
 from srm.ringmasterd import RingMasterServer
+from srm.utils import write_md5_sidecar, run_in_child, WorkerError, \
+    get_md5sum, make_backup
 
 
 class FakedBuilder(object):
@@ -244,9 +250,12 @@ class test_ringmasterserver(unittest.TestCase):
         rmd.logger = MagicMock()
         ok_balance = 0
         bad_balance = 42.0
-        builder.get_balance = MagicMock(return_value=ok_balance)
-        self.assertTrue(rmd.ring_balance_ok(builder))
-        builder.get_balance.return_value = bad_balance
+        with patch('srm.ringmasterd.get_stats') as fstats:
+            fstats.return_value = Mock(balance=ok_balance)
+            self.assertTrue(rmd.ring_balance_ok(builder))
+            fstats.return_value = Mock(balance=bad_balance)
+            self.assertFalse(rmd.ring_balance_ok(builder))
+        # an unbalanced builder isn't ok
         self.assertFalse(rmd.ring_balance_ok(builder))
 
     def test_min_part_hours_ok(self):
@@ -307,6 +316,7 @@ class test_ringmasterserver(unittest.TestCase):
         rmd.ring_balance_ok = MagicMock(return_value=True)
         rmd.rebalance_ring = MagicMock(return_value=True)
         rmd.write_builder = MagicMock(return_value=True)
+        rmd.prepare_ring = MagicMock(return_value='/tmp/prepared.ring.gz')
         rmd.write_ring = MagicMock(return_value=True)
 
         def _reset_all():
@@ -411,5 +421,364 @@ class test_ringmasterserver(unittest.TestCase):
         rmd.ring_balance_ok.return_value = True
         _reset_all()
 
+    @patch('srm.ringmasterd.time')
+    def test_run_pass(self, ftime):
+        ftime.return_value = 1000.0
+        self._setup_builder_rings(count=4, balanced=False)
+        self.confdict['status_file'] = os.path.join(self.testdir, 'status')
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        rmd.pause_if_asked = MagicMock()
+        rmd.in_change_window = MagicMock(return_value=True)
+        rmd.orchestration_pass = MagicMock(return_value=True)
+        self.assertEquals(rmd.run_pass('object'), 2)
+        rmd.orchestration_pass.return_value = False
+        self.assertEquals(rmd.run_pass('account'), 1)
+        rmd.orchestration_pass.side_effect = Exception('boom')
+        self.assertEquals(rmd.run_pass('container'), 60)
+        self.assertEquals(rmd.next_run, {'object': 1002.0,
+                                         'account': 1001.0,
+                                         'container': 1060.0})
+        with open(self.confdict['status_file']) as f:
+            status = json.load(f)
+        self.assertEquals(status['object'], {'next_check': 1002.0,
+                                             'last_result': 'changed'})
+        self.assertEquals(status['account']['last_result'], 'unchanged')
+        self.assertEquals(status['container']['last_result'], 'error')
+        rmd.in_change_window.return_value = False
+        rmd.orchestration_pass.reset_mock()
+        self.assertEquals(rmd.run_pass('object'), 60)
+        self.assertFalse(rmd.orchestration_pass.called)
+
+    def test_start(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        rmd.start_event_watchers = MagicMock()
+        rmd.orchestration_loop = MagicMock()
+        rmd.start()
+        self.assertTrue(rmd.start_event_watchers.called)
+        self.assertEquals(sorted(c[0][0] for c in
+                                 rmd.orchestration_loop.call_args_list),
+                          ['account', 'container', 'object'])
+
+    def test_orchestration_pass_builder_replaced(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        rmd.ring_requires_change = MagicMock(return_value=True)
+        rmd.min_part_hours_ok = MagicMock(return_value=True)
+        rmd.min_modify_time = MagicMock(return_value=True)
+        rmd.dispersion_ok = MagicMock(return_value=True)
+        rmd.ring_balance_ok = MagicMock(return_value=True)
+        rmd.write_builder = MagicMock(return_value=True)
+        rmd.write_ring = MagicMock(return_value=True)
+
+        def _replace_builder(builder):
+            # someone else writes the builder while we're rebalancing
+            FakedBuilder(device_count=5).write_builder(
+                self.confdict['object_builder'],
+                FakedBuilder(device_count=5).gen_builder())
+            return True
+
+        rmd.rebalance_ring = MagicMock(side_effect=_replace_builder)
+        prepared = os.path.join(self.testdir, 'prepared.ring.gz')
+        open(prepared, 'w').close()
+        rmd.prepare_ring = MagicMock(return_value=prepared)
+        self.assertFalse(rmd.orchestration_pass('object'))
+        self.assertFalse(os.path.exists(prepared))
+        self.assertTrue(rmd.rebalance_ring.called)
+        self.assertFalse(rmd.write_builder.called)
+        self.assertFalse(rmd.write_ring.called)
+
+    def test_orchestration_loop_wakeup(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        rmd.run_pass = MagicMock(side_effect=StopIteration)
+        rmd.next_run['object'] = time.time() + 300
+        rmd.wake('object')
+        # woken rings don't wait for their timer
+        start = time.time()
+        self.assertRaises(StopIteration, rmd.orchestration_loop, 'object')
+        self.assertTrue(time.time() - start < 5)
+        rmd.run_pass.assert_called_once_with('object')
+        self.assertFalse(rmd.wakeups['object'].ready())
+
+    def test_handle_event(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        self.confdict['pause_file_path'] = os.path.join(self.testdir, 'pause')
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        # a builder we wrote ourselves doesn't wake the ring
+        rmd.known_identity['object'] = rmd._builder_identity('object')
+        rmd.handle_event(self.confdict['object_builder'])
+        self.assertFalse(rmd.wakeups['object'].ready())
+        # but one someone else wrote does
+        rmd.handle_event(self.confdict['account_builder'])
+        self.assertTrue(rmd.wakeups['account'].ready())
+        self.assertFalse(rmd.wakeups['container'].ready())
+        # removing the pause file resumes
+        open(self.confdict['pause_file_path'], 'w').close()
+        rmd.handle_event(self.confdict['pause_file_path'])
+        self.assertFalse(rmd.resume.ready())
+        os.unlink(self.confdict['pause_file_path'])
+        rmd.handle_event(self.confdict['pause_file_path'])
+        self.assertTrue(rmd.resume.ready())
+
+    @patch('srm.ringmasterd.time')
+    def test_run_pass_event_gates(self, ftime):
+        ftime.return_value = 1000.0
+        self._setup_builder_rings(count=4, balanced=False)
+        self.confdict['status_file'] = os.path.join(self.testdir, 'status')
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        rmd.pause_if_asked = MagicMock()
+        rmd.in_change_window = MagicMock(return_value=True)
+
+        def _gated(btype):
+            rmd.gate_opens[btype] = 1500.0
+            return False
+
+        rmd.orchestration_pass = MagicMock(side_effect=_gated)
+        # without events we keep polling every interval
+        self.assertEquals(rmd.run_pass('object'), 1)
+        # with events we only need to wake when the gate opens
+        rmd.events_active = True
+        self.assertEquals(rmd.run_pass('object'), 500)
+        rmd.orchestration_pass.side_effect = None
+        rmd.orchestration_pass.return_value = False
+        self.assertEquals(rmd.run_pass('object'), 1)
+
+    def test_start_event_watchers(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        orig_handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            rmd.start_event_watchers()
+            self.assertTrue(rmd.events_active)
+            rmd.known_identity['account'] = rmd._builder_identity('account')
+            FakedBuilder(device_count=5).write_builder(
+                self.confdict['object_builder'],
+                FakedBuilder(device_count=5).gen_builder())
+            for i in xrange(50):
+                eventlet.sleep(0.01)
+                if rmd.wakeups['object'].ready():
+                    break
+            self.assertTrue(rmd.wakeups['object'].ready())
+            self.assertFalse(rmd.wakeups['account'].ready())
+            # admin trigger wakes everything
+            os.kill(os.getpid(), signal.SIGUSR1)
+            for i in xrange(50):
+                eventlet.sleep(0.01)
+                if rmd.wakeups['account'].ready():
+                    break
+            self.assertTrue(rmd.wakeups['account'].ready())
+            self.assertTrue(rmd.wakeups['container'].ready())
+        finally:
+            signal.signal(signal.SIGUSR1, orig_handler)
+
+    def test_load_builder(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        with patch('srm.ringmasterd.RingBuilder.load',
+                   wraps=RingBuilder.load) as fload:
+            identity, builder = rmd.load_builder('object')
+            self.assertEquals(rmd.load_builder('object'),
+                              (identity, builder))
+            self.assertEquals(fload.call_count, 1)
+            # a new builder file gets loaded
+            FakedBuilder(device_count=5).write_builder(
+                self.confdict['object_builder'],
+                FakedBuilder(device_count=5).gen_builder())
+            new_identity, new_builder = rmd.load_builder('object')
+            self.assertEquals(fload.call_count, 2)
+            self.assertNotEquals(new_identity, identity)
+            self.assertEquals(len([d for d in new_builder.devs if d]), 5)
+            # as does a change to the builders sidecar
+            write_md5_sidecar(self.confdict['object_builder'], 'abc')
+            self.assertEquals(rmd.load_builder('object')[0][3], 'abc')
+            self.assertEquals(fload.call_count, 3)
+
+    def test_ring_lock(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.lock_timeout = 0.1
+        with rmd._ring_lock('account'):
+            # other rings aren't held up
+            with rmd._ring_lock('object'):
+                pass
+            with rmd._ring_lock('container'):
+                pass
+            # but the same ring is
+            self.assertRaises(LockTimeout,
+                              rmd._ring_lock('account').__enter__)
+        self.assertTrue(os.path.exists(
+            self.confdict['account_builder'] + '.lock'))
+        with rmd._ring_lock('account'):
+            pass
+
+    def test_working_copy(self):
+        builder = RingBuilder(8, 3, 0)
+        for i in xrange(4):
+            builder.add_dev({'id': i, 'region': 1, 'zone': i,
+                             'ip': '1.1.1.1', 'port': 6010,
+                             'device': 'sd%s' % i, 'weight': 100.0})
+        builder.rebalance()
+        orig = builder.to_dict()
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        work = rmd._working_copy(builder)
+        work.set_dev_weight(0, 10.0)
+        work.rebalance()
+        self.assertEquals(work.devs[0]['weight'], 10.0)
+        self.assertNotEquals(work._replica2part2dev,
+                             builder._replica2part2dev)
+        self.assertEquals(builder.to_dict(), orig)
+
+    def _gen_builder(self):
+        builder = RingBuilder(8, 3, 0)
+        for i in xrange(4):
+            builder.add_dev({'id': i, 'region': 1, 'zone': i,
+                             'ip': '1.1.1.1', 'port': 6010,
+                             'device': 'sd%s' % i, 'weight': 100.0})
+        return builder
+
+    def test_run_in_child(self):
+        self.assertNotEquals(run_in_child(os.getpid), os.getpid())
+        self.assertEquals(run_in_child(sorted, ([3, 1, 2],)), [1, 2, 3])
+        # exceptions come back to the parent
+        self.assertRaises(ValueError, run_in_child, int, ('monkey',))
+        # as do children that run too long
+        start = time.time()
+        self.assertRaises(WorkerError, run_in_child, time.sleep, (30,),
+                          timeout=0.5, tmpdir=self.testdir)
+        self.assertTrue(time.time() - start < 10)
+        # or run out of memory
+        self.assertRaises((MemoryError, WorkerError), run_in_child,
+                          lambda: 'x' * (2 ** 34),
+                          memory_limit=2 ** 33)
+        # the limit is on top of what the child inherits, however much
+        # the parent already has mapped
+        inherited = mmap.mmap(-1, 2 ** 30)
+        try:
+            self.assertEquals(run_in_child(lambda: len('x' * 2 ** 24),
+                                           memory_limit=2 ** 26), 2 ** 24)
+            self.assertRaises((MemoryError, WorkerError), run_in_child,
+                              lambda: 'x' * (2 ** 27), memory_limit=2 ** 26)
+        finally:
+            inherited.close()
+        # or die on their own
+        self.assertRaises(WorkerError, run_in_child, os._exit, (3,))
+        self.assertEquals([f for f in os.listdir(self.testdir)
+                           if f.endswith('.tmp.result')], [])
+
+    def test_rebalance_ring_in_worker(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        self.assertTrue(rmd.isolate_rebalance)
+        builder = self._gen_builder()
+        self.assertTrue(rmd.rebalance_ring(builder))
+        # the parent gets the workers rebalanced builder
+        self.assertEquals(sum(d['parts'] for d in builder.devs),
+                          builder.parts * builder.replicas)
+        self.assertFalse(builder.devs_changed)
+        ring_file = os.path.join(self.testdir, 'object.ring.gz')
+        rmd.write_ring('object', builder)
+        ring = RingData.load(ring_file)
+        self.assertEquals(ring._replica2part2dev_id,
+                          builder._replica2part2dev)
+
+    def test_rebalance_ring_worker_errors(self):
+        self.confdict['rebalance_timeout'] = '1'
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        builder = self._gen_builder()
+        with patch('srm.ringmasterd._rebalance_builder',
+                   lambda b: time.sleep(30)):
+            self.assertFalse(rmd.rebalance_ring(builder))
+        self.assertTrue(builder.devs_changed)
+        self.assertEquals(builder._replica2part2dev, None)
+        with patch('srm.ringmasterd._rebalance_builder',
+                   MagicMock(side_effect=RingBuilderError('nope'))):
+            self.assertFalse(rmd.rebalance_ring(builder))
+        # with isolation off it all still happens in process
+        rmd.isolate_rebalance = False
+        with patch('srm.ringmasterd.run_in_child') as fchild:
+            self.assertTrue(rmd.rebalance_ring(builder))
+            self.assertFalse(fchild.called)
+
+    def test_ring_write_retried(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        builder = self._gen_builder()
+        builder.rebalance()
+        FakedBuilder().write_builder(self.confdict['object_builder'], builder)
+        ring_file = self.confdict['object_ring']
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        rmd.ring_requires_change = MagicMock(return_value=True)
+        rmd.min_modify_time = MagicMock(return_value=True)
+        rmd.dispersion_ok = MagicMock(return_value=True)
+        rmd.ring_balance_ok = MagicMock(return_value=False)
+        rmd.rebalance_ring = MagicMock(return_value=True)
+        write_ring = rmd.write_ring
+        old_ring_md5 = get_md5sum(ring_file)
+
+        def _backup(filename, backup_dir):
+            if filename == ring_file:
+                raise IOError('disk full')
+            return make_backup(filename, backup_dir)
+
+        with patch('srm.ringmasterd.make_backup', _backup):
+            self.assertFalse(rmd.orchestration_pass('object'))
+        self.assertEquals(rmd.ring_pending, set(['object']))
+        self.assertEquals(get_md5sum(ring_file), old_ring_md5)
+        self.assertEquals([f for f in os.listdir(self.testdir)
+                           if '.tmp.' in f], [])
+        # the builder went out, so the next pass needs no change but still
+        # writes the ring
+        rmd.ring_requires_change.return_value = False
+        rmd.write_ring = MagicMock(wraps=write_ring)
+        self.assertTrue(rmd.orchestration_pass('object'))
+        self.assertEquals(rmd.ring_pending, set())
+        ring = RingData.load(ring_file)
+        self.assertEquals(ring._replica2part2dev_id,
+                          builder._replica2part2dev)
+        self.assertFalse(rmd.orchestration_pass('object'))
+        self.assertEquals(rmd.write_ring.call_count, 1)
+
+    def test_write_ring_needs_no_worker(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        builder = self._gen_builder()
+        builder.rebalance()
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        prepared = rmd.prepare_ring('object', builder)
+        # another rings rebalance has the only worker slot
+        rmd.worker_slots.acquire()
+        with eventlet.Timeout(5):
+            ring_md5 = rmd.write_ring('object', builder, prepared)
+        self.assertEquals(get_md5sum(self.confdict['object_ring']), ring_md5)
+        self.assertFalse(os.path.exists(prepared))
+
+    def test_write_ring_sidecar_fails(self):
+        self._setup_builder_rings(count=4, balanced=False)
+        builder = self._gen_builder()
+        builder.rebalance()
+        rmd = RingMasterServer(rms_conf={'ringmasterd': self.confdict})
+        rmd.logger = MagicMock()
+        ring_file = self.confdict['object_ring']
+        write_md5_sidecar(ring_file, get_md5sum(ring_file))
+        with patch('srm.ringmasterd.write_md5_sidecar') as fsidecar:
+            fsidecar.side_effect = IOError('No space left on device')
+            ring_md5 = rmd.write_ring('object', builder)
+        # the ring still goes out, without the now wrong sidecar
+        self.assertEquals(get_md5sum(ring_file), ring_md5)
+        self.assertFalse(os.path.exists(ring_file + '.md5'))
+        self.assertTrue(rmd.logger.exception.called)
+
+
 if __name__ == '__main__':
     unittest.main()
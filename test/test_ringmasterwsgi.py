@@ -1,16 +1,26 @@
 import os
 import time
+import json
+import eventlet
+import urllib2
 import unittest
+import random
+from array import array
+from StringIO import StringIO
+from eventlet import wsgi
 import cPickle as pickle
 from shutil import rmtree
 from tempfile import mkdtemp
-from mock import MagicMock
+from mock import MagicMock, patch
 from swift.common.swob import Request
-from swift.common.ring import RingBuilder
+from swift.common.ring import RingBuilder, RingData
 from swift.common.utils import lock_parent_directory
 from swift.common.exceptions import LockTimeout
-from srm.ringmasterwsgi import RingMasterApp
-from srm.utils import get_md5sum
+from srm.ringmasterwsgi import RingMasterApp, SendfileBody
+from srm.sendfile import sendfile
+from srm.inotify import inotify_available
+from srm.utils import get_md5sum, apply_ring_delta, write_md5_sidecar, \
+    KeepAliveHandler
 
 
 class FakeApp(object):
@@ -23,8 +33,8 @@ class FakedBuilder(object):
     def __init__(self, device_count=5):
         self.device_count = device_count
 
-    def gen_builder(self, balanced=False):
-        builder = RingBuilder(18, 3, 1)
+    def gen_builder(self, balanced=False, part_power=18):
+        builder = RingBuilder(part_power, 3, 1)
         for i in xrange(self.device_count):
             zone = i
             ipaddr = "1.1.1.1"
@@ -37,9 +47,9 @@ class FakedBuilder(object):
                 next_dev_id = max(d['id'] for d in builder.devs if d) + 1
             builder.add_dev({'id': next_dev_id, 'zone': zone, 'ip': ipaddr,
                              'port': int(port), 'device': device_name,
-                             'weight': weight, 'meta': meta})
-            if balanced:
-                builder.rebalance()
+                             'weight': weight, 'meta': meta, 'region': 1})
+        if balanced:
+            builder.rebalance()
         return builder
 
     def write_builder(self, tfile, builder):
@@ -81,6 +91,37 @@ class test_ringmasterwsgi(unittest.TestCase):
             rma._validate_file(i)
             self.assertFalse(rma._changed(i))
 
+    def test_ring_cache(self):
+        self._setup_builder_rings()
+        rma = RingMasterApp({'swiftdir': self.testdir, 'log_path': self.test_log_path})
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        payload = rma._validate_file(target)
+        self.assertEquals(payload.md5, get_md5sum(target))
+        self.assertEquals(payload.length, os.path.getsize(target))
+        with open(target, 'rb') as f:
+            self.assertEquals(payload.body, f.read())
+        # unchanged file serves the same payload
+        self.assertTrue(rma._validate_file(target) is payload)
+        # replacing the file with the same mtime still swaps the payload
+        st = os.stat(target)
+        self._setup_builder_rings(count=5)
+        os.utime(target, (st.st_atime, st.st_mtime))
+        new_payload = rma._validate_file(target)
+        self.assertFalse(new_payload is payload)
+        self.assertEquals(new_payload.md5, get_md5sum(target))
+        self.assertEquals(rma.current_md5[target], new_payload.md5)
+
+    def test_ring_cache_md5_sidecar(self):
+        self._setup_builder_rings()
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        write_md5_sidecar(target, 'sidecarmd5')
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path})
+        self.assertEquals(rma.current_md5[target], 'sidecarmd5')
+        # a stale sidecar is ignored
+        self._setup_builder_rings(count=5)
+        self.assertEquals(rma._validate_file(target).md5, get_md5sum(target))
+
     def test_ringmaster_validate_locked_dir(self):
         self._setup_builder_rings()
         rma = RingMasterApp({'swiftdir': self.testdir, 'log_path': self.test_log_path, 'locktimeout': "0.1"})
@@ -110,7 +151,7 @@ class test_ringmasterwsgi(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'HEAD'})
         resp = rma.handle_request(req.environ, start_response)
         account_md5 = get_md5sum(os.path.join(self.testdir, 'account.ring.gz'))
-        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5)])
+        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5), ('Content-Location', '/ring/account.ring.gz/' + account_md5)])
         self.assertEquals(resp, [])
 
     def test_handle_ring(self):
@@ -141,7 +182,7 @@ class test_ringmasterwsgi(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'HEAD'})
         resp = rma.handle_ring(req.environ, start_response)
         account_md5 = get_md5sum(os.path.join(self.testdir, 'account.ring.gz'))
-        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5)])
+        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5), ('Content-Location', '/ring/account.ring.gz/' + account_md5)])
         self.assertEquals(resp, [])
 
         # test GET w/ current If-None-Match
@@ -152,8 +193,9 @@ class test_ringmasterwsgi(unittest.TestCase):
                                      'HTTP_IF_NONE_MATCH': account_md5})
         resp = rma.handle_ring(req.environ, start_response)
         start_response.assert_called_with('304 Not Modified', [(
-            'Content-Type', 'application/octet-stream')])
-        self.assertEquals(resp, ['Not Modified\r\n'])
+            'Content-Type', 'application/octet-stream'), (
+            'Cache-Control', 'max-age=60')])
+        self.assertEquals(resp, [])
 
         # test GET w/ outdated If-None-Match
         start_response.reset_mock()
@@ -162,7 +204,7 @@ class test_ringmasterwsgi(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'GET',
                                      'HTTP_IF_NONE_MATCH': 'ihazaring'})
         resp = rma.handle_ring(req.environ, start_response)
-        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5)])
+        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5), ('Content-Location', '/ring/account.ring.gz/' + account_md5)])
         testfile1 = os.path.join(self.testdir, 'gettest1.file')
         with open(testfile1, 'w') as f:
             for i in resp:
@@ -175,12 +217,699 @@ class test_ringmasterwsgi(unittest.TestCase):
         req = Request.blank('/ring/account.ring.gz',
                             environ={'REQUEST_METHOD': 'GET'})
         resp = rma.handle_ring(req.environ, start_response)
-        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5)])
+        start_response.assert_called_with('200 OK', [('Content-Type', 'application/octet-stream'), ('Etag', account_md5), ('Content-Location', '/ring/account.ring.gz/' + account_md5)])
         testfile2 = os.path.join(self.testdir, 'gettest2.file')
         with open(testfile2, 'w') as f:
             for i in resp:
                 f.write(i)
         self.assertTrue(account_md5, get_md5sum(testfile2))
 
+    def test_handle_ring_file_serve_modes(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        account_md5 = get_md5sum(target)
+        account_size = str(os.path.getsize(target))
+        expected_headers = [('Content-Type', 'application/octet-stream'),
+                            ('Etag', account_md5),
+                            ('Content-Location',
+                             '/ring/account.ring.gz/' + account_md5),
+                            ('Content-Length', account_size)]
+        self.assertRaises(ValueError, RingMasterApp,
+                          {'swiftdir': self.testdir,
+                           'log_path': self.test_log_path,
+                           'serve_mode': 'carrier-pigeon'})
+
+        # sendfile w/ a file_wrapper from the server
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'serve_mode': 'sendfile'})
+        file_wrapper = MagicMock(return_value=['wrapped'])
+        req = Request.blank('/ring/account.ring.gz',
+                            environ={'REQUEST_METHOD': 'GET',
+                                     'wsgi.file_wrapper': file_wrapper})
+        resp = rma.handle_ring(req.environ, start_response)
+        self.assertEquals(resp, ['wrapped'])
+        self.assertEquals(file_wrapper.call_args[0][0].name, target)
+        file_wrapper.call_args[0][0].close()
+        start_response.assert_called_with('200 OK', expected_headers)
+
+        # sendfile w/o a file_wrapper falls back to the iterator
+        start_response.reset_mock()
+        req = Request.blank('/ring/account.ring.gz',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with('200 OK', expected_headers)
+        body = ''.join(resp)
+        resp.close()
+        with open(target, 'rb') as f:
+            self.assertEquals(body, f.read())
+
+        # file replaced after being cached is served from memory
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'serve_mode': 'iterator'})
+        rma._changed = MagicMock(return_value=False)
+        self._setup_builder_rings(count=5)
+        start_response.reset_mock()
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', account_md5),
+                       ('Content-Location',
+                        '/ring/account.ring.gz/' + account_md5)])
+        self.assertEquals(len(resp), 1)
+
+    def test_handle_ring_delta(self):
+        # a realistically sized ring, 2^18 partitions on 200 devices
+        rand = random.Random(1)
+        devs = [{'id': i, 'zone': i % 5, 'region': 1, 'ip': '1.1.1.%d' % i,
+                 'port': 6010, 'device': 'sda', 'weight': 100.0}
+                for i in xrange(200)]
+        part_shift = 32 - 18
+        tables = [array('H', [rand.randrange(200) for _ in xrange(2 ** 18)])
+                  for _ in xrange(3)]
+        target = os.path.join(self.testdir, 'object.ring.gz')
+        RingData(tables, devs, part_shift).save(target)
+        start_response = MagicMock()
+        with open(target, 'rb') as f:
+            old_ring = f.read()
+        old_md5 = get_md5sum(target)
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path})
+        # a rebalance moving 2% of the partitions, one replica each
+        for part in rand.sample(xrange(2 ** 18), 2 ** 18 // 50):
+            tables[rand.randrange(3)][part] = rand.randrange(200)
+        devs.append({'id': 200, 'zone': 0, 'region': 1, 'ip': '1.1.1.200',
+                     'port': 6010, 'device': 'sda', 'weight': 100.0})
+        RingData(tables, devs, part_shift).save(target)
+        new_md5 = get_md5sum(target)
+        rma._validate_file(target)
+        self.assertEquals(
+            [p.md5 for p in rma.ring_history[target]], [old_md5])
+
+        # unknown base gets the full ring
+        req = Request.blank('/ring/object.ring.gz?from=ihazaring',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', new_md5),
+                       ('Content-Location',
+                        '/ring/object.ring.gz/' + new_md5)])
+
+        # known base gets a delta
+        start_response.reset_mock()
+        req = Request.blank('/ring/object.ring.gz?from=%s' % old_md5,
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/x-srm-ring-delta'),
+                       ('Etag', new_md5), ('X-Ring-Delta-Base', old_md5)])
+        delta = ''.join(resp)
+        # much smaller than the ring, not just the header saved
+        self.assertTrue(len(delta) < os.path.getsize(target) / 10)
+        new_ring = apply_ring_delta(old_ring, delta)
+        with open(target, 'rb') as f:
+            self.assertEquals(new_ring, f.read())
+
+        # current base with If-None-Match is still a 304
+        start_response.reset_mock()
+        req = Request.blank('/ring/object.ring.gz?from=%s' % new_md5,
+                            environ={'REQUEST_METHOD': 'GET',
+                                     'HTTP_IF_NONE_MATCH': new_md5})
+        resp = rma.handle_ring(req.environ, start_response)
+        self.assertEquals(resp, [])
+
+        # a delta that doesn't save enough isn't worth sending
+        for table in tables:
+            rand.shuffle(table)
+        RingData(tables, devs, part_shift).save(target)
+        newer_md5 = get_md5sum(target)
+        rma._validate_file(target)
+        start_response.reset_mock()
+        req = Request.blank('/ring/object.ring.gz?from=%s' % new_md5,
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        self.assertEquals(rma.delta_cache[target], {new_md5: None})
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', newer_md5),
+                       ('Content-Location',
+                        '/ring/object.ring.gz/' + newer_md5)])
+
+        # neither is one across a part power change
+        RingData([t[:2 ** 17] for t in tables], devs,
+                 part_shift + 1).save(target)
+        rma._validate_file(target)
+        req = Request.blank('/ring/object.ring.gz?from=%s' % newer_md5,
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        self.assertEquals(rma.delta_cache[target], {newer_md5: None})
+        self.assertEquals(start_response.call_args[0][1][0],
+                          ('Content-Type', 'application/octet-stream'))
+
+    def test_handle_watch(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path})
+        target = os.path.join(self.testdir, 'object.ring.gz')
+        account_md5 = get_md5sum(os.path.join(self.testdir,
+                                              'account.ring.gz'))
+        object_md5 = get_md5sum(target)
+
+        # no rings to watch
+        req = Request.blank('/watch?timeout=1',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '400 Bad Request', [('Content-Type', 'text/plain')])
+
+        # stale md5 returns right away
+        req = Request.blank('/watch?account=%s&object=old&timeout=30'
+                            % account_md5,
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/json')])
+        self.assertEquals(json.loads(''.join(resp)),
+                          {'account': account_md5, 'object': object_md5})
+
+        # nothing changes before the timeout
+        req = Request.blank('/watch?account=%s&object=%s&timeout=0.1'
+                            % (account_md5, object_md5),
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '304 Not Modified', [('Content-Type', 'text/plain')])
+
+        # ring change wakes up the watcher
+        def _change_ring():
+            self._setup_builder_rings(count=5)
+            rma._validate_file(target)
+
+        eventlet.spawn_after(0.1, _change_ring)
+        started = time.time()
+        req = Request.blank('/watch?account=%s&object=%s&timeout=10'
+                            % (account_md5, object_md5),
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        self.assertTrue(time.time() - started < 5)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/json')])
+        self.assertEquals(json.loads(''.join(resp))['object'],
+                          get_md5sum(target))
+
+    def test_handle_watch_max_watchers(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'max_watchers': '1',
+                             'poll_interval_active': '5'})
+        account_md5 = get_md5sum(os.path.join(self.testdir,
+                                              'account.ring.gz'))
+        path = '/watch?account=%s&timeout=%s'
+
+        def _watch(timeout, md5=account_md5):
+            req = Request.blank(path % (md5, timeout),
+                                environ={'REQUEST_METHOD': 'GET'})
+            return rma.handle_request(req.environ, MagicMock())
+
+        waiter = eventlet.spawn(_watch, 10)
+        eventlet.sleep(0)
+        self.assertEquals(rma.active_watchers, 1)
+        # no room for another watcher
+        req = Request.blank(path % (account_md5, 10),
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '503 Service Unavailable', [('Content-Type', 'text/plain'),
+                                        ('Retry-After', '5')])
+        # a stale md5 doesn't need to wait, so it's still answered
+        req = Request.blank(path % ('old', 10),
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/json')])
+        waiter.kill()
+        self.assertEquals(rma.active_watchers, 0)
+        _watch(0.01)
+        self.assertEquals(rma.active_watchers, 0)
+
+    def test_handle_manifest(self):
+        self._setup_builder_rings()
+        os.unlink(os.path.join(self.testdir, 'container.ring.gz'))
+        start_response = MagicMock()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path})
+        req = Request.blank('/rings', environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_request(req.environ, start_response)
+        status, headers = start_response.call_args[0]
+        self.assertEquals(status, '200 OK')
+        etag = dict(headers)['Etag']
+        manifest = json.loads(''.join(resp))
+        self.assertEquals(sorted(manifest.keys()),
+                          ['account.ring.gz', 'object.ring.gz'])
+        for rfile in manifest:
+            target = os.path.join(self.testdir, rfile)
+            self.assertEquals(manifest[rfile]['md5'], get_md5sum(target))
+            self.assertEquals(manifest[rfile]['size'],
+                              os.path.getsize(target))
+            self.assertEquals(manifest[rfile]['mtime'],
+                              os.stat(target).st_mtime)
+        # unchanged
+        req = Request.blank('/rings', environ={'REQUEST_METHOD': 'GET',
+                                               'HTTP_IF_NONE_MATCH': etag})
+        resp = rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '304 Not Modified', [('Content-Type', 'application/json'),
+                                 ('Cache-Control', 'max-age=60')])
+        # changed
+        self._setup_builder_rings(count=5)
+        resp = rma.handle_request(req.environ, start_response)
+        status, headers = start_response.call_args[0]
+        self.assertEquals(status, '200 OK')
+        self.assertNotEquals(dict(headers)['Etag'], etag)
+        # rings that just changed get polled more often
+        self.assertEquals(dict(headers)['Cache-Control'], 'max-age=10')
+        rma.last_change -= 1800
+        rma.handle_request(req.environ, start_response)
+        status, headers = start_response.call_args[0]
+        self.assertEquals(dict(headers)['Cache-Control'], 'max-age=60')
+        self.assertEquals(len(json.loads(''.join(resp))), 3)
+
+    def test_inotify_change_watcher(self):
+        if not inotify_available():
+            return
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'use_inotify': 'y'})
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        rma._start_change_watcher()
+        self.assertTrue(rma.inotify_active)
+        eventlet.sleep(0.1)
+        generation = rma.generation[target]
+        self._setup_builder_rings(count=5)
+        for i in xrange(50):
+            eventlet.sleep(0.05)
+            if rma.generation[target] != generation and \
+                    not rma._changed(target):
+                break
+        # the new ring was prefetched before any request came in
+        self.assertEquals(rma.current_md5[target], get_md5sum(target))
+        # and requests don't stat the ring
+        with patch('srm.ringmasterwsgi.stat') as fstat:
+            req = Request.blank('/ring/account.ring.gz',
+                                environ={'REQUEST_METHOD': 'HEAD'})
+            rma.handle_ring(req.environ, start_response)
+            self.assertFalse(fstat.called)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', get_md5sum(target)),
+                       ('Content-Location',
+                        '/ring/account.ring.gz/' + get_md5sum(target))])
+
+    def test_mmap_rings(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'workers': '4', 'file_chunk_size': '100'})
+        self.assertTrue(rma.mmap_rings)
+        payload = rma._validate_file(target)
+        self.assertFalse(isinstance(payload.body, str))
+        self.assertEquals(payload.md5, get_md5sum(target))
+        req = Request.blank('/ring/account.ring.gz',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', payload.md5),
+                       ('Content-Location',
+                        '/ring/account.ring.gz/' + payload.md5),
+                       ('Content-Length', str(os.path.getsize(target)))])
+        with open(target, 'rb') as f:
+            self.assertEquals(''.join(resp), f.read())
+
+    @patch('srm.ringmasterwsgi.signal')
+    @patch('srm.ringmasterwsgi.os')
+    def test_run_workers(self, fos, fsignal):
+        self._setup_builder_rings()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'workers': '2'})
+        rma.logger = MagicMock()
+        fos.fork.side_effect = [101, 102, 103]
+        fos.wait.side_effect = [(101, 9), OSError(4, 'EINTR'),
+                                (999, 0), KeyboardInterrupt()]
+        self.assertRaises(KeyboardInterrupt, rma._run_workers, 'sock')
+        # two workers started and the dead one was replaced
+        self.assertEquals(fos.fork.call_count, 3)
+        self.assertEquals(rma.logger.error.call_count, 1)
+
+    def test_max_concurrent_downloads(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        account_md5 = get_md5sum(target)
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'max_concurrent_downloads': '2'})
+        req = Request.blank('/ring/account.ring.gz',
+                            environ={'REQUEST_METHOD': 'GET'})
+        first = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', account_md5),
+                       ('Content-Location',
+                        '/ring/account.ring.gz/' + account_md5),
+                       ('Content-Length', str(os.path.getsize(target)))])
+        second = rma.handle_ring(req.environ, start_response)
+        self.assertEquals(rma.active_downloads, 2)
+        # cap reached
+        rma.download_time = 4.2
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '503 Service Unavailable', [('Content-Type', 'text/plain'),
+                                        ('Retry-After', '5')])
+        # 304s and HEADs are not limited
+        cond_req = Request.blank('/ring/account.ring.gz',
+                                 environ={'REQUEST_METHOD': 'GET',
+                                          'HTTP_IF_NONE_MATCH': account_md5})
+        resp = rma.handle_ring(cond_req.environ, start_response)
+        self.assertEquals(resp, [])
+        head_req = Request.blank('/ring/account.ring.gz',
+                                 environ={'REQUEST_METHOD': 'HEAD'})
+        resp = rma.handle_ring(head_req.environ, start_response)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        # finishing a download frees up a slot
+        with open(target, 'rb') as f:
+            self.assertEquals(''.join(first), f.read())
+        first.close()
+        first.close()
+        self.assertEquals(rma.active_downloads, 1)
+        self.assertTrue(rma.download_time < 4.2)
+        resp = rma.handle_ring(req.environ, start_response)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+
+    def test_handle_ring_version(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        old_md5 = get_md5sum(target)
+        with open(target, 'rb') as f:
+            old_ring = f.read()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'immutable_max_age': '600'})
+        rma._validate_file(target)
+        self._setup_builder_rings(count=5)
+        rma._validate_file(target)
+        new_md5 = get_md5sum(target)
+        cache_control = ('Cache-Control', 'public, max-age=600, immutable')
+
+        # old version is still served from history
+        req = Request.blank('/ring/account.ring.gz/%s' % old_md5,
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', old_md5), cache_control])
+        self.assertEquals(''.join(resp), old_ring)
+
+        # current version
+        req = Request.blank('/ring/account.ring.gz/%s' % new_md5,
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', new_md5), cache_control])
+        self.assertEquals(resp, [])
+        req = Request.blank('/ring/account.ring.gz/%s' % new_md5,
+                            environ={'REQUEST_METHOD': 'GET',
+                                     'HTTP_IF_NONE_MATCH': new_md5})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '304 Not Modified', [('Content-Type', 'application/octet-stream'),
+                                 cache_control])
+
+        # unknown version
+        req = Request.blank('/ring/account.ring.gz/ihazaring',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '404 Not Found', [('Content-Type', 'text/plain')])
+
+        # mutable url can redirect full downloads to the versioned one
+        rma.redirect_immutable = True
+        req = Request.blank('/ring/account.ring.gz',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '302 Found', [('Content-Type', 'text/plain'),
+                          ('Location', '/ring/account.ring.gz/' + new_md5)])
+
+        # a version published since the last request is picked up
+        self._setup_builder_rings(count=6)
+        newer_md5 = get_md5sum(target)
+        req = Request.blank('/ring/account.ring.gz/%s' % newer_md5,
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        resp = rma.handle_ring(req.environ, start_response)
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/octet-stream'),
+                       ('Etag', newer_md5), cache_control])
+
+    def test_convergence(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path})
+        target = os.path.join(self.testdir, 'object.ring.gz')
+        obj_md5 = get_md5sum(target)
+        published = os.stat(target).st_mtime
+
+        def report(hostname, md5sum, delay, latency=None):
+            body = json.dumps({'hostname': hostname, 'rings': {
+                'object.ring.gz': {'md5': md5sum,
+                                   'installed': published + delay,
+                                   'install_latency': latency},
+                'bogus.ring.gz': {'md5': 'x', 'installed': 1}}})
+            req = Request.blank('/report', environ={'REQUEST_METHOD': 'POST'},
+                                body=body)
+            return rma.handle_request(req.environ, start_response)
+
+        for i in range(9):
+            self.assertEquals(report('node%d' % i, obj_md5, i + 1, 0.5), [])
+            start_response.assert_called_with('204 No Content', [])
+        report('node9', 'oldmd5', 0)
+        # reports replace earlier ones from the same host
+        report('node8', obj_md5, 9, 0.25)
+        reports = rma._load_reports()
+        self.assertEquals(len(reports), 10)
+        self.assertEquals(reports['node0']['rings'].keys(),
+                          ['object.ring.gz'])
+        self.assertEquals(len(os.listdir(rma.report_dir)), 10)
+        # bad reports
+        bad_values = [{'md5': 'x'}, {'md5': 'x', 'installed': '1'},
+                      {'md5': 'x', 'installed': 1, 'install_latency': 'a'},
+                      {'md5': 'x', 'installed': 1, 'install_latency': -1},
+                      {'md5': 'x', 'installed': 1, 'install_latency': True}]
+        bad_bodies = ['notjson', json.dumps({'rings': {}})] + [
+            json.dumps({'hostname': 'x', 'rings': {'object.ring.gz': info}})
+            for info in bad_values]
+        # json.dumps writes NaN and Infinity, and json.loads reads them
+        bad_bodies += ['{"hostname": "x", "rings": {"object.ring.gz": '
+                       '{"md5": "x", "installed": 1, "install_latency": '
+                       '%s}}}' % value for value in ('NaN', 'Infinity')]
+        for body in bad_bodies:
+            req = Request.blank('/report', environ={'REQUEST_METHOD': 'POST'},
+                                body=body)
+            rma.handle_request(req.environ, start_response)
+            start_response.assert_called_with(
+                '400 Bad Request', [('Content-Type', 'text/plain')])
+        rma.max_report_size = 10
+        report('node10', obj_md5, 1)
+        start_response.assert_called_with(
+            '400 Bad Request', [('Content-Type', 'text/plain')])
+        req = Request.blank('/report', environ={'REQUEST_METHOD': 'GET'})
+        rma.handle_request(req.environ, start_response)
+        start_response.assert_called_with(
+            '501 Not Implemented', [('Content-Type', 'text/plain')])
+
+        req = Request.blank('/status/convergence',
+                            environ={'REQUEST_METHOD': 'GET'})
+        status = json.loads(''.join(rma.handle_request(req.environ,
+                                                       start_response)))
+        start_response.assert_called_with(
+            '200 OK', [('Content-Type', 'application/json')])
+        obj = status['object.ring.gz']
+        self.assertEquals(obj['md5'], obj_md5)
+        self.assertEquals(obj['hosts'], 10)
+        self.assertEquals(obj['converged'], 9)
+        self.assertEquals(obj['pct'], 90.0)
+        self.assertEquals(obj['lagging'], ['node9'])
+        self.assertEquals(obj['propagation_latency'],
+                          {'p50': 5, 'p90': 9, 'p99': 9, 'max': 9})
+        self.assertEquals(obj['install_latency'],
+                          {'p50': 0.5, 'p90': 0.5, 'p99': 0.5, 'max': 0.5})
+        # nobody has reported the account ring
+        self.assertEquals(status['account.ring.gz']['pct'], 0.0)
+        self.assertEquals(status['account.ring.gz']['propagation_latency'],
+                          None)
+        # other workers see the same reports
+        other = RingMasterApp({'swiftdir': self.testdir,
+                               'log_path': self.test_log_path})
+        self.assertEquals(json.loads(''.join(other.handle_request(
+            req.environ, start_response))), status)
+        # hosts that stop reporting are dropped
+        node9 = rma._report_path('node9')
+        old = time.time() - 3601
+        os.utime(node9, (old, old))
+        status = json.loads(''.join(rma.handle_request(req.environ,
+                                                       start_response)))
+        self.assertEquals(status['object.ring.gz']['pct'], 100.0)
+        self.assertFalse(os.path.exists(node9))
+        # new hosts are refused once the table is full
+        rma.max_report_size = 65536
+        rma.max_reports = 9
+        report('node10', obj_md5, 1)
+        start_response.assert_called_with(
+            '503 Service Unavailable', [('Content-Type', 'text/plain')])
+        self.assertFalse(os.path.exists(rma._report_path('node10')))
+        # but hosts already in it can still report
+        report('node0', obj_md5, 1)
+        start_response.assert_called_with('204 No Content', [])
+        # and expired reports are cleared out to make room
+        old = time.time() - 3601
+        os.utime(rma._report_path('node1'), (old, old))
+        report('node10', obj_md5, 1)
+        start_response.assert_called_with('204 No Content', [])
+        self.assertFalse(os.path.exists(rma._report_path('node1')))
+        self.assertEquals(rma._expire_reports(), 9)
+        # reports that can't be saved
+        with patch('srm.ringmasterwsgi.mkstemp') as fmkstemp:
+            fmkstemp.side_effect = OSError('No space left on device')
+            report('node0', obj_md5, 1)
+        start_response.assert_called_with(
+            '503 Service Unavailable', [('Content-Type', 'text/plain')])
+
+    def test_max_send_rate(self):
+        self._setup_builder_rings()
+        start_response = MagicMock()
+        target = os.path.join(self.testdir, 'account.ring.gz')
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'max_send_rate': '100'})
+        req = Request.blank('/ring/account.ring.gz',
+                            environ={'REQUEST_METHOD': 'GET'})
+        with patch('srm.ringmasterwsgi.TokenBucket') as fbucket:
+            resp = rma.handle_ring(req.environ, start_response)
+            fbucket.assert_called_once_with(100, 100)
+            status, headers = start_response.call_args[0]
+            self.assertEquals(dict(headers)['Content-Length'],
+                              str(os.path.getsize(target)))
+            chunks = list(resp)
+            resp.close()
+        self.assertTrue(max(map(len, chunks)) <= 100)
+        with open(target, 'rb') as f:
+            self.assertEquals(''.join(chunks), f.read())
+        self.assertEquals(
+            [c[0][0] for c in fbucket.return_value.consume.call_args_list],
+            map(len, chunks))
+
+    def test_keepalive_304(self):
+        self._setup_builder_rings()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path})
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, sock, rma, log=StringIO())
+        try:
+            url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+            opener = urllib2.build_opener(KeepAliveHandler())
+            md5 = get_md5sum(os.path.join(self.testdir, 'object.ring.gz'))
+            req = urllib2.Request(url + '/ring/object.ring.gz',
+                                  headers={'If-None-Match': md5})
+            for i in range(2):
+                try:
+                    opener.open(req, timeout=2)
+                except urllib2.HTTPError, err:
+                    self.assertEquals(err.code, 304)
+                    self.assertEquals(err.read(), '')
+                else:
+                    self.fail('expected a 304')
+                # the next request on the connection isn't confused by it
+                resp = opener.open(url + '/rings', timeout=2)
+                self.assertTrue('object.ring.gz' in json.loads(resp.read()))
+            req = urllib2.Request(url + '/ring/object.ring.gz')
+            req.get_method = lambda: 'HEAD'
+            self.assertEquals(opener.open(req, timeout=2).read(), '')
+            resp = opener.open(url + '/rings', timeout=2)
+            self.assertTrue('object.ring.gz' in json.loads(resp.read()))
+        finally:
+            server.kill()
+            sock.close()
+
+    def test_client_timeout(self):
+        self._setup_builder_rings()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'client_timeout': '0.5', 'max_clients': '4'})
+        with patch('srm.ringmasterwsgi.wsgi.server') as fserver:
+            rma._serve('sock')
+            fserver.assert_called_once_with(
+                'sock', rma, log=rma.request_logger, max_size=4,
+                socket_timeout=0.5)
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(rma._serve, sock)
+        try:
+            conn = eventlet.connect(sock.getsockname())
+            conn.settimeout(5)
+            # idle clients get hung up on
+            start = time.time()
+            self.assertEquals(conn.recv(1024), '')
+            self.assertTrue(time.time() - start < 4)
+        finally:
+            server.kill()
+            sock.close()
+
+    def test_sendfile_serve_mode(self):
+        self._setup_builder_rings()
+        rma = RingMasterApp({'swiftdir': self.testdir,
+                             'log_path': self.test_log_path,
+                             'serve_mode': 'sendfile'})
+        target = os.path.join(self.testdir, 'object.ring.gz')
+        with open(target, 'rb') as f:
+            ring = f.read()
+        self.assertTrue(len(ring) > 16)
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, sock, rma, log=StringIO())
+        try:
+            url = 'http://127.0.0.1:%d/ring/object.ring.gz' % \
+                sock.getsockname()[1]
+            opener = urllib2.build_opener(KeepAliveHandler())
+            patch_head = patch.object(SendfileBody, 'head_size', 16)
+            with patch_head:
+                with patch('srm.ringmasterwsgi.sendfile',
+                           wraps=sendfile) as fsendfile:
+                    for i in range(2):
+                        resp = opener.open(url, timeout=5)
+                        self.assertEquals(resp.read(), ring)
+                        self.assertEquals(resp.headers['etag'],
+                                          get_md5sum(target))
+                    self.assertEquals(fsendfile.call_count, 2)
+                    # no sendfile when throttling
+                    rma.max_send_rate = 1024 * 1024 * 1024
+                    self.assertEquals(opener.open(url, timeout=5).read(), ring)
+                    self.assertEquals(fsendfile.call_count, 2)
+        finally:
+            server.kill()
+            sock.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,27 @@
 import os
+import signal
+import time
+import sys
+import struct
+from array import array
+from gzip import GzipFile
 import unittest
 import cPickle as pickle
 from shutil import rmtree
 from tempfile import mkdtemp
 from mock import MagicMock, patch
-from swift.common.ring import RingBuilder
-from srm.ringminion import RingMinion
-from srm.utils import get_md5sum
+from swift.common.ring import RingBuilder, RingData
+from srm.ringminion import RingMinion, RingMiniond
+from srm.utils import get_md5sum, make_ring_delta, KeepAliveHandler, \
+    is_valid_ring, _check_ring_structure, TokenBucket, GreenHTTPHandler
 from swift.common import utils
 import urllib2
+import json
+from hashlib import md5
+import eventlet
+from eventlet import wsgi
+from eventlet.green import subprocess
+from StringIO import StringIO
 
 class MockResponse(object):
 
@@ -18,8 +31,9 @@ class MockResponse(object):
         self.msg = msg
         self.headers = {'content-type': 'text/plain; charset=utf-8'}
 
-    def read(self):
-        return self.resp_data
+    def read(self, size=None):
+        data, self.resp_data = self.resp_data, ''
+        return data
 
     def getcode(self):
         return self.code
@@ -163,5 +177,777 @@ class test_ringmasterminion(unittest.TestCase):
         minion.logger.exception.assert_called_with('Error retrieving or checking on ring')
         minion.logger.exception.reset_mock()
 
+    def test_fetch_ring_delta(self):
+        builder = FakedBuilder(device_count=6).gen_builder()
+        builder.change_min_part_hours(0)
+        builder.rebalance(seed=1)
+        obj_ring = os.path.join(self.testdir, 'object.ring.gz')
+        builder.get_ring().save(obj_ring)
+        old_md5 = get_md5sum(obj_ring)
+        with open(obj_ring, 'rb') as f:
+            old_ring = f.read()
+        builder.set_dev_weight(0, 90.0)
+        builder.rebalance(seed=1)
+        new_ring_path = os.path.join(self.testdir, 'new.ring.gz')
+        builder.get_ring().save(new_ring_path)
+        new_md5 = get_md5sum(new_ring_path)
+        with open(new_ring_path, 'rb') as f:
+            new_ring = f.read()
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        minion.logger = MagicMock()
+
+        # delta applied on top of the current ring
+        response = MockResponse(resp_data=make_ring_delta(old_ring, new_ring))
+        response.headers = {'etag': new_md5, 'x-ring-delta-base': old_md5}
+        self.urlopen_mock.return_value = response
+        self.assertTrue(minion.fetch_ring('object'))
+        request = self.urlopen_mock.call_args[0][0]
+        self.assertTrue(request.get_full_url().endswith('?from=%s' % old_md5))
+        self.assertEquals(get_md5sum(obj_ring), new_md5)
+        self.assertEquals(minion.current_md5[obj_ring], new_md5)
+
+        # bad delta falls back to a full download
+        with open(obj_ring, 'wb') as f:
+            f.write(old_ring)
+        minion.current_md5[obj_ring] = old_md5
+        bad_response = MockResponse(resp_data='garbage')
+        bad_response.headers = {'etag': new_md5,
+                                'x-ring-delta-base': old_md5}
+        full_response = MockResponse(resp_data=new_ring)
+        full_response.headers = {'etag': new_md5}
+        self.urlopen_mock.reset_mock()
+        self.urlopen_mock.side_effect = [bad_response, full_response]
+        self.assertTrue(minion.fetch_ring('object'))
+        self.assertEquals(self.urlopen_mock.call_count, 2)
+        request = self.urlopen_mock.call_args[0][0]
+        self.assertFalse('?from=' in request.get_full_url())
+        self.assertEquals(get_md5sum(obj_ring), new_md5)
+
+    def test_wait_for_change(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'watch_mode': 'y'})
+        minion.logger = MagicMock()
+        # ring changed
+        self.urlopen_mock.return_value = MockResponse(code=200)
+        self.assertTrue(minion.wait_for_change())
+        url = self.urlopen_mock.call_args[0][0]
+        self.assertTrue(url.startswith('http://127.0.0.1:8090/watch?'))
+        self.assertTrue('timeout=300' in url)
+        self.assertTrue('object=&' in url or url.endswith('object='))
+        # timed out with no change
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {}, None)
+        self.assertFalse(minion.wait_for_change())
+        # errors fall back to polling
+        self.urlopen_mock.side_effect = urllib2.URLError('oops')
+        self.assertEquals(minion.wait_for_change(), None)
+        with patch('srm.ringminion.sleep') as fsleep:
+            minion.wait_for_next_pass()
+            fsleep.assert_called_once_with(minion.check_interval)
+            fsleep.reset_mock()
+            self.urlopen_mock.side_effect = None
+            minion.wait_for_next_pass()
+            self.assertFalse(fsleep.called)
+
+    def test_check_rings(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        minion.logger = MagicMock()
+        minion.fetch_ring = MagicMock(return_value=True)
+        obj_ring = os.path.join(self.testdir, 'object.ring.gz')
+        account_ring = os.path.join(self.testdir, 'account.ring.gz')
+        minion.current_md5[obj_ring] = 'objmd5'
+        minion.current_md5[account_ring] = 'oldaccountmd5'
+        manifest = {'object.ring.gz': {'md5': 'objmd5', 'size': 1,
+                                       'mtime': 1.0},
+                    'account.ring.gz': {'md5': 'accountmd5', 'size': 1,
+                                        'mtime': 1.0}}
+        response = MockResponse(resp_data=json.dumps(manifest))
+        response.headers = {'etag': 'manifestetag'}
+        self.urlopen_mock.return_value = response
+        results = minion.check_rings()
+        self.assertEquals(results, {'object': None, 'account': True,
+                                    'container': True})
+        self.assertEquals(sorted(c[0][0] for c in
+                                 minion.fetch_ring.call_args_list),
+                          ['account', 'container'])
+        self.assertEquals(minion.manifest_etag, 'manifestetag')
+        # unchanged manifest is reused
+        minion.fetch_ring.reset_mock()
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {}, None)
+        minion.current_md5[account_ring] = 'accountmd5'
+        results = minion.check_rings()
+        request = self.urlopen_mock.call_args[0][0]
+        self.assertEquals(request.get_header('If-none-match'),
+                          'manifestetag')
+        self.assertEquals(results, {'object': None, 'account': None,
+                                    'container': True})
+        # no manifest, check every ring
+        minion.fetch_ring.reset_mock()
+        self.urlopen_mock.side_effect = urllib2.URLError('oops')
+        results = minion.check_rings()
+        self.assertEquals(minion.fetch_ring.call_count, 3)
+
+    def test_md5_sidecar(self):
+        obj_ring = os.path.join(self.testdir, 'object.ring.gz')
+        with open(obj_ring, 'wb') as f:
+            f.write('notreallyaring')
+        real_md5 = get_md5sum(obj_ring)
+        # no sidecar, hash the ring
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        self.assertEquals(minion.current_md5[obj_ring], real_md5)
+        # installed rings get a sidecar that is used on startup
+        tmppath = os.path.join(self.testdir, 'new.ring.gz.tmp')
+        with open(tmppath, 'wb') as f:
+            f.write('anotherring')
+        minion._move_in_place(tmppath, 'object', 'sidecarmd5')
+        self.assertTrue(os.path.exists(obj_ring + '.md5'))
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        self.assertEquals(minion.current_md5[obj_ring], 'sidecarmd5')
+        # stale sidecar is ignored
+        with open(obj_ring, 'ab') as f:
+            f.write('more')
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        self.assertEquals(minion.current_md5[obj_ring], get_md5sum(obj_ring))
+
+    @patch('srm.ringminion.sleep')
+    def test_fetch_ring_retry_after(self, fsleep):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'busy_retries': '2'})
+        minion.logger = MagicMock()
+        busy = urllib2.HTTPError('http://a.com', 503, 'Busy',
+                                 {'retry-after': '10'}, None)
+        self.urlopen_mock.side_effect = [busy, busy, urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {}, None)]
+        self.assertEquals(minion.fetch_ring('object'), None)
+        self.assertEquals(self.urlopen_mock.call_count, 3)
+        self.assertEquals(fsleep.call_count, 2)
+        for c in fsleep.call_args_list:
+            self.assertTrue(10 <= c[0][0] <= 20)
+        self.assertFalse(minion.logger.exception.called)
+        # still busy after all the retries defers to the next pass
+        fsleep.reset_mock()
+        self.urlopen_mock.reset_mock()
+        self.urlopen_mock.side_effect = [busy, busy, busy]
+        self.assertEquals(minion.fetch_ring('object'), None)
+        self.assertEquals(self.urlopen_mock.call_count, 3)
+        self.assertEquals(fsleep.call_count, 2)
+        self.assertFalse(minion.logger.exception.called)
+        # a 503 without Retry-After is still an error
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 503, 'Busy', {}, None)
+        self.assertFalse(minion.fetch_ring('object'))
+        minion.logger.exception.assert_called_with(
+            'Error communicating with ring-master')
+
+    def test_ring_master_failover(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'ring_master': 'http://relay:8090/, '
+                                                 'http://master:8090/',
+                                  'use_manifest': 'n'})
+        minion.logger = MagicMock()
+        self.assertEquals(minion.ring_masters,
+                          ['http://relay:8090/', 'http://master:8090/'])
+        self.assertEquals(minion.ring_master, 'http://relay:8090/')
+        self.urlopen_mock.side_effect = [
+            urllib2.URLError('connection refused'),
+            urllib2.HTTPError('http://a.com', 304, 'Nope', {}, None)]
+        self.assertEquals(minion.fetch_ring('object'), None)
+        self.assertEquals(self.urlopen_mock.call_count, 2)
+        urls = [c[0][0].get_full_url()
+                for c in self.urlopen_mock.call_args_list]
+        self.assertTrue(urls[0].startswith('http://relay:8090/ring/'))
+        self.assertTrue(urls[1].startswith('http://master:8090/ring/'))
+        self.assertEquals(minion.ring_master, 'http://master:8090/')
+        # no one left to fail over to
+        self.urlopen_mock.reset_mock()
+        self.urlopen_mock.side_effect = urllib2.URLError('nope')
+        self.assertFalse(minion.fetch_ring('object'))
+        self.assertEquals(self.urlopen_mock.call_count, 1)
+        # with everything failing the next pass starts on the ring master
+        # thats been failing the longest
+        self.urlopen_mock.reset_mock()
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {}, None)
+        minion.check_rings()
+        self.assertEquals(minion.ring_master, 'http://relay:8090/')
+
+    @patch('srm.ringminion.monkey_patch')
+    @patch('srm.ringminion.spawn_n')
+    @patch('srm.ringminion.listen')
+    def test_start_relay(self, flisten, fspawn, fmonkey):
+        self._setup_obj_ring(balanced=False)
+        minion = RingMinion(conf={
+            'swiftdir': self.testdir, 'relay': 'y', 'relay_port': '9090',
+            'relay_log_path': os.path.join(self.testdir, 'relay.log')})
+        minion.logger = MagicMock()
+        self.assertTrue(minion.relay_enabled)
+        minion.start_relay()
+        flisten.assert_called_once_with(('', 9090))
+        fspawn.assert_called_once_with(minion.relay.start,
+                                       flisten.return_value)
+        self.assertTrue(fmonkey.called)
+        # the relay serves what the minion has installed
+        obj_ring = os.path.join(self.testdir, 'object.ring.gz')
+        self.assertEquals(minion.relay.swiftdir, self.testdir)
+        self.assertEquals(minion.relay.current_md5[obj_ring],
+                          get_md5sum(obj_ring))
+
+    @patch('srm.ringminion.monkey_patch')
+    @patch('srm.ringminion.spawn_n')
+    @patch('srm.ringminion.listen')
+    def test_start_relay_fails(self, flisten, fspawn, fmonkey):
+        self._setup_obj_ring(balanced=False)
+        log_path = os.path.join(self.testdir, 'logs', 'relay.log')
+        minion = RingMinion(conf={
+            'swiftdir': self.testdir, 'relay': 'y',
+            'relay_log_path': log_path})
+        minion.logger = MagicMock()
+        # port already taken
+        flisten.side_effect = IOError('Address already in use')
+        self.assertFalse(minion.start_relay())
+        self.assertFalse(minion.relay_enabled)
+        self.assertEquals(minion.relay, None)
+        self.assertFalse(fspawn.called)
+        self.assertTrue(minion.logger.exception.called)
+        # the missing log dir got made
+        self.assertTrue(os.path.isdir(os.path.dirname(log_path)))
+        # and the watch loop doesn't try again
+        with patch.object(minion, 'start_relay') as fstart:
+            with patch('srm.ringminion.sleep') as fsleep:
+                fsleep.side_effect = [None, Exception('stop')]
+                minion.check_rings = MagicMock(return_value={})
+                minion.wait_for_next_pass = MagicMock(
+                    side_effect=Exception('stop'))
+                minion.report_status = False
+                self.assertRaises(Exception, minion.watch_loop)
+                self.assertFalse(fstart.called)
+
+    @patch('srm.ringminion.sleep')
+    @patch('srm.ringminion.RingMinion')
+    def test_ringminiond_run_sleeps(self, fminion, fsleep):
+        fminion.return_value.watch_loop.side_effect = Exception('boom')
+        fminion.return_value.check_interval = 30
+
+        class Stop(BaseException):
+            pass
+
+        fsleep.side_effect = [None, Stop()]
+        daemon = RingMiniond(os.path.join(self.testdir, 'minion.pid'))
+        self.assertRaises(Stop, daemon.run, {})
+        self.assertEquals(fminion.return_value.watch_loop.call_count, 2)
+        fsleep.assert_called_with(30)
+
+    def test_green_without_keepalive(self):
+
+        def app(env, start_response):
+            eventlet.sleep(0.5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+
+        with patch('srm.ringminion.urllib2.install_opener') as finstall:
+            minion = RingMinion(conf={'swiftdir': self.testdir,
+                                      'keepalive': 'n'})
+        self.assertEquals(minion.keepalive, None)
+        opener = finstall.call_args[0][0]
+        self.assertTrue([h for h in opener.handlers
+                         if isinstance(h, GreenHTTPHandler)])
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, sock, app, log=StringIO())
+        try:
+            url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+            started = time.time()
+            pool = eventlet.GreenPool()
+            bodies = list(pool.imap(
+                lambda i: opener.open(url, timeout=5).read(), range(4)))
+            self.assertEquals(bodies, ['ok'] * 4)
+            # fetched at the same time, not one after another
+            self.assertTrue(time.time() - started < 1.5)
+        finally:
+            server.kill()
+            sock.close()
+
+    def test_keepalive_handler(self):
+
+        def app(env, start_response):
+            if env['PATH_INFO'] == '/missing':
+                start_response('304 Not Modified', [])
+                return []
+            if env['PATH_INFO'] == '/sloppy':
+                # a 304 with a body httplib won't read
+                start_response('304 Not Modified', [])
+                return ['Not Modified\r\n']
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [env['REMOTE_PORT']]
+
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, sock, app, log=StringIO())
+        try:
+            url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+            handler = KeepAliveHandler()
+            opener = urllib2.build_opener(handler)
+            ports = [opener.open(url, timeout=5).read() for i in range(3)]
+            # all requests went over the same connection
+            self.assertEquals(len(set(ports)), 1)
+            # bodyless responses give the connection right back
+            self.assertRaises(urllib2.HTTPError, opener.open,
+                              url + 'missing', timeout=5)
+            self.assertEquals(opener.open(url, timeout=5).read(), ports[0])
+            # unless the server sent a body with it anyway
+            self.assertRaises(urllib2.HTTPError, opener.open,
+                              url + 'sloppy', timeout=5)
+            self.assertNotEquals(opener.open(url, timeout=5).read(),
+                                 ports[0])
+            # a response that wasn't read doesn't go back to the pool
+            opener.open(url, timeout=5).close()
+            self.assertEquals(handler.idle.values(), [[]])
+            self.assertNotEquals(opener.open(url, timeout=5).read(),
+                                 ports[0])
+            # idle connections the server closed are replaced
+            for conn, idle_since in handler.idle.values()[0]:
+                conn.sock.close()
+            self.assertTrue(opener.open(url, timeout=5).read())
+            # connections idle for too long aren't reused
+            port = opener.open(url, timeout=5).read()
+            conn, idle_since = handler.idle.values()[0][0]
+            handler.idle.values()[0][0] = (conn, idle_since - 60)
+            self.assertNotEquals(opener.open(url, timeout=5).read(), port)
+            self.assertEquals(conn.sock, None)
+            handler.close_idle()
+            self.assertEquals(handler.idle.values(), [[]])
+            # concurrent requests get their own connections
+            pool = eventlet.GreenPool()
+            ports = list(pool.imap(lambda i: opener.open(url, timeout=5),
+                                   range(3)))
+            self.assertEquals(len(set(r.read() for r in ports)), 3)
+        finally:
+            server.kill()
+            sock.close()
+
+    def test_write_ring(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'read_chunk_size': '16'})
+        data = 'x' * 1000
+        data_md5 = md5(data).hexdigest()
+        response = StringIO(data)
+        response.read = MagicMock(side_effect=response.read)
+        tmppath = minion._write_ring(response, 'object', data_md5)
+        with open(tmppath, 'rb') as f:
+            self.assertEquals(f.read(), data)
+        os.unlink(tmppath)
+        sizes = [c[0][0] for c in response.read.call_args_list]
+        self.assertEquals(set(sizes), set([16]))
+        # md5 missmatch is caught before anything is synced to disk
+        with patch('srm.ringminion.os.fsync') as ffsync:
+            try:
+                minion._write_ring(StringIO(data), 'object', 'badmd5')
+            except Exception as err:
+                self.assertEqual(err.message, 'md5 missmatch')
+            else:
+                self.fail('Should have thrown md5 missmatch exception')
+            self.assertFalse(ffsync.called)
+        self.assertEquals(
+            [f for f in os.listdir(self.testdir) if f.endswith('.tmp')], [])
+
+    def test_is_valid_ring(self):
+        ring_file = os.path.join(self.testdir, 'object.ring.gz')
+        devs = [{'id': 0, 'zone': 0, 'region': 1, 'ip': '1.1.1.1',
+                 'port': 6010, 'device': 'sda', 'weight': 100.0},
+                None,
+                {'id': 2, 'zone': 1, 'region': 1, 'ip': '1.1.1.2',
+                 'port': 6010, 'device': 'sdb', 'weight': 100.0}]
+        part_shift = 32 - 8
+        good = [array('H', [0, 2] * 128), array('H', [2, 0] * 128)]
+
+        def save(replica2part2dev_id, devs=devs, part_shift=part_shift):
+            RingData(replica2part2dev_id, devs, part_shift).save(ring_file)
+
+        save(good)
+        self.assertTrue(is_valid_ring(ring_file))
+        self.assertTrue(is_valid_ring(ring_file, strict=True))
+        # small chunks still see the whole ring
+        self.assertTrue(_check_ring_structure(ring_file, chunk_size=7))
+        # fractional replicas leave the last replica short
+        save([good[0], good[1][:100]])
+        self.assertTrue(is_valid_ring(ring_file))
+        # missing replicas
+        save([good[0][:100], array('H')])
+        self.assertFalse(is_valid_ring(ring_file))
+        # points at a device that doesn't exist
+        save([good[0], array('H', [0, 3] * 128)])
+        self.assertFalse(is_valid_ring(ring_file))
+        # points at a removed device
+        save([good[0], array('H', [0, 1] * 128)])
+        self.assertFalse(is_valid_ring(ring_file))
+        # no devices
+        save(good, devs=[None, None, None])
+        self.assertFalse(is_valid_ring(ring_file))
+        # too many partitions for the part power
+        save([good[0], good[1] + good[1]])
+        self.assertFalse(is_valid_ring(ring_file))
+        # truncated
+        save(good)
+        with open(ring_file, 'rb') as f:
+            data = f.read()
+        with open(ring_file, 'wb') as f:
+            f.write(data[:-20])
+        self.assertFalse(is_valid_ring(ring_file))
+        # not a ring at all
+        with open(ring_file, 'wb') as f:
+            f.write('whatisthis.')
+        self.assertFalse(is_valid_ring(ring_file))
+        # rings written on hosts with the other byte order
+        other = 'big' if sys.byteorder == 'little' else 'little'
+        swapped = [array('H', r) for r in good]
+        for r in swapped:
+            r.byteswap()
+        header = json.dumps({'devs': devs, 'part_shift': part_shift,
+                             'replica_count': 2, 'byteorder': other})
+        gz = GzipFile(ring_file, 'wb')
+        gz.write('R1NG' + struct.pack('!H', 1) +
+                 struct.pack('!I', len(header)) + header)
+        for r in swapped:
+            gz.write(r.tostring())
+        gz.close()
+        self.assertTrue(is_valid_ring(ring_file))
+        self.assertTrue(is_valid_ring(ring_file, strict=True))
+        # an unknown format version is left to the full ring load
+        save(good)
+        gz = GzipFile(ring_file, 'rb')
+        data = gz.read()
+        gz.close()
+        gz = GzipFile(ring_file, 'wb')
+        gz.write('R1NG' + struct.pack('!H', 2) + data[6:])
+        gz.close()
+        self.assertEquals(_check_ring_structure(ring_file), None)
+        with patch('srm.utils.Ring') as fring:
+            fring.return_value.devs = devs
+            self.assertTrue(is_valid_ring(ring_file))
+            fring.assert_called_once_with(ring_file)
+        # which still fails rings it can't load
+        self.assertFalse(is_valid_ring(ring_file))
+
+    def test_next_check_interval(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'use_manifest': 'n',
+                                  'max_check_interval': '300'})
+        minion.logger = MagicMock()
+        self.assertEquals(minion.next_check_interval(), 30)
+        # follow the ring master's hint
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {'cache-control': 'max-age=10'},
+            None)
+        self.assertEquals(minion.fetch_ring('object'), None)
+        self.assertEquals(minion.next_check_interval(), 10)
+        # hints are clamped
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {'cache-control': 'max-age=1'},
+            None)
+        minion.fetch_ring('object')
+        self.assertEquals(minion.next_check_interval(), 5)
+        minion.poll_hint = None
+        response = MockResponse(resp_data='{}')
+        response.headers = {'etag': 'x', 'cache-control': 'max-age=86400'}
+        self.urlopen_mock.side_effect = None
+        self.urlopen_mock.return_value = response
+        minion.fetch_manifest()
+        self.assertEquals(minion.next_check_interval(), 300)
+        # failed passes back off
+        minion.failures = 1
+        self.assertTrue(30 <= minion.next_check_interval() <= 60)
+        minion.failures = 3
+        self.assertTrue(120 <= minion.next_check_interval() <= 240)
+        minion.failures = 10
+        self.assertTrue(150 <= minion.next_check_interval() <= 300)
+        # and don't watch while failing
+        minion.watch_mode = True
+        minion.wait_for_change = MagicMock()
+        with patch('srm.ringminion.sleep') as fsleep:
+            minion.wait_for_next_pass()
+            self.assertTrue(fsleep.called)
+        self.assertFalse(minion.wait_for_change.called)
+
+    def test_ring_master_selection(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'ring_master': 'http://a:8090/,'
+                                                 'http://b:8090/,'
+                                                 'http://c:8090/',
+                                  'ring_master_timeout': '30'})
+        minion.logger = MagicMock()
+        # untried ring masters keep the configured order
+        self.assertEquals(minion._ranked_ring_masters(),
+                          ['http://a:8090/', 'http://b:8090/',
+                           'http://c:8090/'])
+        minion._record_success('http://a:8090/', 0.5)
+        minion._record_success('http://b:8090/', 0.1)
+        minion._record_success('http://c:8090/', 0.3)
+        self.assertEquals(minion._ranked_ring_masters(),
+                          ['http://b:8090/', 'http://c:8090/',
+                           'http://a:8090/'])
+        # latency is smoothed
+        minion._record_success('http://b:8090/', 1.1)
+        self.assertAlmostEquals(
+            minion.endpoints['http://b:8090/']['latency'], 0.4)
+        # failed ring masters go last until they've sat out a while
+        minion._record_success('http://b:8090/', 0.1)
+        minion._record_error('http://c:8090/')
+        self.assertEquals(minion._ranked_ring_masters(),
+                          ['http://b:8090/', 'http://a:8090/',
+                           'http://c:8090/'])
+        minion.endpoints['http://c:8090/']['retry_at'] = time.time() - 1
+        self.assertEquals(minion._ranked_ring_masters()[0],
+                          'http://c:8090/')
+        # shorter timeout while theres somewhere to fail over to
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {}, None)
+        minion.check_rings()
+        self.assertEquals(self.urlopen_mock.call_args[1]['timeout'], 5)
+        minion.failed_this_pass = set(['http://a:8090/', 'http://b:8090/'])
+        minion.ring_master = 'http://c:8090/'
+        minion.fetch_ring('object')
+        self.assertEquals(self.urlopen_mock.call_args[1]['timeout'], 30)
+        # a manifest failure fails over too
+        self.urlopen_mock.reset_mock()
+        response = MockResponse(resp_data='{}')
+        response.headers = {'etag': 'x'}
+        self.urlopen_mock.side_effect = [urllib2.URLError('oops'), response]
+        minion.failed_this_pass = set()
+        minion.ring_master = 'http://a:8090/'
+        self.assertEquals(minion.fetch_manifest(), {})
+        self.assertEquals(self.urlopen_mock.call_count, 2)
+        self.assertNotEquals(minion.ring_master, 'http://a:8090/')
+
+    def test_fetch_ring_requires_etag(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        minion.logger = MagicMock()
+        minion._move_in_place = MagicMock()
+        self.urlopen_mock.return_value = MockResponse(resp_data='aring')
+        self.assertFalse(minion.fetch_ring('object'))
+        self.assertFalse(minion._move_in_place.called)
+        # and the body has to match it
+        response = MockResponse(resp_data='aring')
+        response.headers = {'etag': 'notthemd5'}
+        self.urlopen_mock.return_value = response
+        self.assertFalse(minion.fetch_ring('object'))
+        self.assertFalse(minion._move_in_place.called)
+
+    def test_send_report(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'hostname': 'node1'})
+        minion.logger = MagicMock()
+        obj_ring = os.path.join(self.testdir, 'object.ring.gz')
+        tmppath = os.path.join(self.testdir, 'new.ring.gz.tmp')
+        with open(tmppath, 'wb') as f:
+            f.write('aring')
+        minion._move_in_place(tmppath, 'object', 'objmd5')
+        minion.install_latency[obj_ring] = 1.5
+        self.urlopen_mock.return_value = MockResponse(code=204)
+        self.assertTrue(minion.send_report())
+        request = self.urlopen_mock.call_args[0][0]
+        self.assertEquals(request.get_full_url(),
+                          'http://127.0.0.1:8090/report')
+        self.assertEquals(request.get_method(), 'POST')
+        report = json.loads(request.get_data())
+        self.assertEquals(report, {
+            'hostname': 'node1',
+            'rings': {'object.ring.gz': {
+                'md5': 'objmd5', 'install_latency': 1.5,
+                'installed': os.stat(obj_ring).st_mtime}}})
+        # report_to overrides where reports go
+        minion.report_to = 'http://master:8090/'
+        minion.send_report()
+        self.assertEquals(self.urlopen_mock.call_args[0][0].get_full_url(),
+                          'http://master:8090/report')
+        # failures are quiet
+        self.urlopen_mock.side_effect = urllib2.URLError('oops')
+        self.assertFalse(minion.send_report())
+        self.assertFalse(minion.logger.exception.called)
+
+    @patch('srm.utils.eventlet.sleep')
+    @patch('srm.utils.time')
+    def test_token_bucket(self, ftime, fsleep):
+        ftime.return_value = 100.0
+        bucket = TokenBucket(1000)
+        # starts with a second's worth
+        self.assertEquals(bucket.consume(1000), 0)
+        self.assertFalse(fsleep.called)
+        # then has to wait for tokens to be earned
+        self.assertEquals(bucket.consume(500), 0.5)
+        fsleep.assert_called_once_with(0.5)
+        ftime.return_value = 101.5
+        self.assertEquals(bucket.consume(1000), 0)
+        # never builds up more than the burst
+        ftime.return_value = 200.0
+        bucket.consume(0)
+        self.assertEquals(bucket.tokens, 1000)
+        # no limit
+        fsleep.reset_mock()
+        bucket = TokenBucket(0)
+        self.assertEquals(bucket.consume(10 ** 9), 0)
+        self.assertFalse(fsleep.called)
+
+    def test_max_download_rate(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'max_download_rate': '32'})
+        self.assertEquals(minion.read_chunk_size, 32)
+        minion.download_bucket = MagicMock()
+        data = 'x' * 100
+        tmppath = minion._write_ring(StringIO(data), 'object')
+        os.unlink(tmppath)
+        self.assertEquals(
+            [c[0][0] for c in minion.download_bucket.consume.call_args_list],
+            [32, 32, 32, 4])
+
+    def test_ring_store(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'ring_store_size': '2'})
+        minion.logger = MagicMock()
+        minion._validate_ring = MagicMock()
+        obj_ring = os.path.join(self.testdir, 'object.ring.gz')
+        versions = []
+        for i in range(3):
+            data = 'ring version %d' % i
+            versions.append(md5(data).hexdigest())
+            tmppath = os.path.join(self.testdir, 'new.ring.gz.tmp')
+            with open(tmppath, 'wb') as f:
+                f.write(data)
+            minion._move_in_place(tmppath, 'object', versions[-1])
+            store_path = minion._store_path('object', versions[-1])
+            os.utime(store_path, (i, i))
+        # only the newest ring_store_size versions are kept
+        self.assertEquals(minion._stored_versions('object'),
+                          [versions[2], versions[1]])
+        self.assertEquals(minion.current_md5[obj_ring], versions[2])
+        # master rolls back to a version we have
+        manifest = {'object.ring.gz': {'md5': versions[1], 'size': 1,
+                                       'mtime': 1.0}}
+        response = MockResponse(resp_data=json.dumps(manifest))
+        response.headers = {'etag': 'manifestetag'}
+        self.urlopen_mock.return_value = response
+        minion.fetch_ring = MagicMock(return_value=None)
+        results = minion.check_rings()
+        self.assertEquals(results['object'], True)
+        self.assertEquals(self.urlopen_mock.call_count, 1)
+        self.assertEquals(
+            sorted(c[0][0] for c in minion.fetch_ring.call_args_list),
+            ['account', 'container'])
+        self.assertEquals(minion.current_md5[obj_ring], versions[1])
+        with open(obj_ring, 'rb') as f:
+            self.assertEquals(f.read(), 'ring version 1')
+        self.assertEquals(minion._stored_versions('object')[0], versions[1])
+        # versions we don't have get fetched, and damaged ones are dropped
+        self.assertFalse(minion.install_from_store('object', versions[0]))
+        with open(minion._store_path('object', versions[2]), 'wb') as f:
+            f.write('garbage')
+        self.assertFalse(minion.install_from_store('object', versions[2]))
+        self.assertFalse(os.path.exists(
+            minion._store_path('object', versions[2])))
+        self.assertEquals(minion.current_md5[obj_ring], versions[1])
+
+    def test_ring_store_delta_base(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir})
+        minion.logger = MagicMock()
+
+        devs = [{'id': 0, 'zone': 0, 'region': 1, 'ip': '1.1.1.1',
+                 'port': 6010, 'device': 'sda', 'weight': 100.0},
+                {'id': 1, 'zone': 1, 'region': 1, 'ip': '1.1.1.2',
+                 'port': 6010, 'device': 'sdb', 'weight': 100.0}]
+        ring_path = os.path.join(self.testdir, 'scratch.ring.gz')
+
+        def ring(table):
+            RingData([array('H', table)], devs, 32 - 8).save(ring_path)
+            with open(ring_path, 'rb') as f:
+                return f.read()
+
+        base = ring([0, 1] * 128)
+        target = ring([0, 1] * 64 + [1, 0] + [0, 1] * 63)
+        base_md5 = md5(base).hexdigest()
+        store_path = minion._store_path('object', base_md5)
+        os.makedirs(os.path.dirname(store_path))
+        with open(store_path, 'wb') as f:
+            f.write(base)
+        # no current ring, so the stored one is the base
+        self.urlopen_mock.side_effect = urllib2.HTTPError(
+            'http://a.com', 304, 'Nope', {}, None)
+        minion.fetch_ring('object')
+        url = self.urlopen_mock.call_args[0][0].get_full_url()
+        self.assertTrue(url.endswith('?from=%s' % base_md5))
+        response = MockResponse(resp_data=make_ring_delta(base, target))
+        response.headers = {'x-ring-delta-base': base_md5,
+                            'etag': md5(target).hexdigest()}
+        tmppath = minion._write_delta_ring(response, 'object')
+        with open(tmppath, 'rb') as f:
+            self.assertEquals(f.read(), target)
+
+    def test_notify_services(self):
+        out = os.path.join(self.testdir, 'notified')
+        pid_file = os.path.join(self.testdir, 'proxy.pid')
+        with open(pid_file, 'w') as f:
+            f.write('1234\n')
+        minion = RingMinion(conf={
+            'swiftdir': self.testdir,
+            'notify_command': "sh -c 'echo $SRM_UPDATED_RINGS >> %s'" % out,
+            'notify_pid_files': pid_file, 'notify_signal': 'usr1'})
+        minion.logger = MagicMock()
+        # nothing installed, nothing to do
+        self.assertTrue(minion.notify_services([]))
+        self.assertFalse(os.path.exists(out))
+        # one notification for everything installed in the pass
+        with patch('srm.ringminion.os.kill') as fkill:
+            self.assertTrue(minion.notify_services(['object', 'account']))
+            fkill.assert_called_once_with(1234, signal.SIGUSR1)
+        with open(out) as f:
+            self.assertEquals(f.read().strip(), ','.join(sorted(
+                [minion.rings['account'], minion.rings['object']])))
+        # failures are reported
+        minion.notify_command = ['sh', '-c', 'exit 3']
+        minion.notify_pid_files = [pid_file + '.missing']
+        self.assertFalse(minion.notify_services(['object']))
+        self.assertEquals(minion.logger.error.call_count, 1)
+        self.assertEquals(minion.logger.exception.call_count, 1)
+        minion.notify_pid_files = []
+        minion.notify_command = ['sleep', '10']
+        minion.notify_timeout = 0.1
+        started = time.time()
+        procs = []
+        real_popen = subprocess.Popen
+
+        def _popen(*args, **kwargs):
+            procs.append(real_popen(*args, **kwargs))
+            return procs[-1]
+
+        with patch('srm.ringminion.subprocess.Popen', _popen):
+            self.assertFalse(minion.notify_services(['object']))
+        self.assertTrue(time.time() - started < 5)
+        minion.logger.error.assert_called_with('notify_command timed out')
+        # the killed command was reaped
+        self.assertEquals(procs[0].returncode, -signal.SIGKILL)
+        self.assertRaises(OSError, os.waitpid, procs[0].pid, os.WNOHANG)
+        # installs in a pass trigger a notification
+        minion.check_rings = MagicMock(return_value={
+            'object': True, 'account': None, 'container': False})
+        minion.notify_services = MagicMock()
+        minion.report_status = False
+        minion.once()
+        minion.notify_services.assert_called_once_with(['object'])
+
+    def test_wait_for_next_pass_closes_idle(self):
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'keepalive_idle_timeout': '30'})
+        minion.logger = MagicMock()
+        minion.keepalive.close_idle = MagicMock()
+        minion.next_check_interval = MagicMock(return_value=10)
+        with patch('srm.ringminion.sleep') as fsleep:
+            minion.wait_for_next_pass()
+            fsleep.assert_called_once_with(10)
+            self.assertFalse(minion.keepalive.close_idle.called)
+            minion.next_check_interval.return_value = 60
+            minion.wait_for_next_pass()
+            self.assertTrue(minion.keepalive.close_idle.called)
+        minion = RingMinion(conf={'swiftdir': self.testdir,
+                                  'keepalive': 'n'})
+        self.assertEquals(minion.keepalive, None)
+
+
 if __name__ == '__main__':
     unittest.main()
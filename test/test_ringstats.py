@@ -0,0 +1,60 @@
+import unittest
+from mock import patch
+from swift.common.ring import RingBuilder
+from srm.ringstats import RingStats, get_stats
+
+
+class test_ringstats(unittest.TestCase):
+
+    def _gen_builder(self, device_count=4, part_power=8):
+        builder = RingBuilder(part_power, 3, 0)
+        for i in xrange(device_count):
+            builder.add_dev({'id': i, 'region': 1, 'zone': i,
+                             'ip': '1.1.1.1', 'port': 6010,
+                             'device': 'sd%s' % i, 'weight': 100.0})
+        builder.rebalance()
+        return builder
+
+    def test_part_counts(self):
+        builder = self._gen_builder()
+        stats = RingStats(builder)
+        self.assertEquals(sum(stats.parts.values()),
+                          builder.parts * builder.replicas)
+        for dev in builder.devs:
+            self.assertEquals(stats.parts[dev['id']], dev['parts'])
+        # the partition tables are never walked
+        builder._replica2part2dev = None
+        self.assertEquals(RingStats(builder).parts, stats.parts)
+
+    def test_ringstats_matches_builder(self):
+        builder = self._gen_builder(device_count=5)
+        builder.set_dev_weight(0, 50.0)
+        builder.add_dev({'id': 5, 'region': 1, 'zone': 1, 'ip': '1.1.1.2',
+                         'port': 6010, 'device': 'sd5', 'weight': 0.0})
+        stats = RingStats(builder)
+        self.assertAlmostEquals(stats.balance, builder.get_balance())
+        for dev_id, balance in builder._build_balance_per_dev().items():
+            self.assertAlmostEquals(stats.balance_per_dev[dev_id], balance)
+        self.assertEquals(stats.parts[5], 0)
+        self.assertEquals(stats.wanted[5], 0)
+        self.assertAlmostEquals(sum(stats.wanted.values()),
+                                builder.parts * builder.replicas)
+
+    def test_get_stats_cached(self):
+        builder = self._gen_builder()
+        with patch('srm.ringstats.RingStats', wraps=RingStats) as fstats:
+            stats = get_stats(builder)
+            self.assertTrue(get_stats(builder) is stats)
+            self.assertEquals(fstats.call_count, 1)
+            # a weight change is a new generation
+            builder.set_dev_weight(0, 50.0)
+            new_stats = get_stats(builder)
+            self.assertEquals(fstats.call_count, 2)
+            self.assertNotEquals(new_stats.balance, stats.balance)
+            builder.rebalance()
+            self.assertAlmostEquals(get_stats(builder).balance,
+                                    builder.get_balance())
+            self.assertEquals(fstats.call_count, 3)
+
+if __name__ == '__main__':
+    unittest.main()